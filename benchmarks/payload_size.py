@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""Estimate the size of batch responses for page metrics.
+
+Compares the payload of a batch request fetching all periods of page metrics
+with per-request headers included (the way the app used to make requests)
+to the one fetching only daily values without headers. Sizes are given both
+as is and gzip-encoded (requests asks for gzip by default).
+
+The responses are synthesized to match the format of Graph API responses,
+so the script doesn't need network access or an access token.
+
+Use -h or --help to see all available options.
+"""
+import argparse
+import gzip
+import io
+import json
+import random
+
+PERIODS = ['day', 'week', 'days_28']
+HEADERS = [
+    {'name': 'Access-Control-Allow-Origin', 'value': '*'},
+    {'name': 'Cache-Control', 'value': 'private, no-cache, no-store, '
+                                       'must-revalidate'},
+    {'name': 'Connection', 'value': 'close'},
+    {'name': 'Content-Type', 'value': 'text/javascript; charset=UTF-8'},
+    {'name': 'ETag', 'value': '"7d8cd4b3c2e0a1f5b9e8d7c6b5a4f3e2d1c0b9a8"'},
+    {'name': 'Expires', 'value': 'Sat, 01 Jan 2000 00:00:00 GMT'},
+    {'name': 'Facebook-API-Version', 'value': 'v2.8'},
+    {'name': 'Pragma', 'value': 'no-cache'},
+    {'name': 'X-App-Usage', 'value': '{"call_count":1,"total_cputime":1,'
+                                     '"total_time":1}'},
+    {'name': 'X-Page-Usage', 'value': '{"call_count":1,"total_cputime":1,'
+                                      '"total_time":1}'},
+]
+
+
+def make_body(graph_id, metric, periods):
+    data = []
+    for period in periods:
+        data.append({
+            'id': '{}/insights/{}/{}'.format(graph_id, metric, period),
+            'name': metric,
+            'period': period,
+            'title': '{} ({})'.format(metric, period),
+            'description': 'A description of the metric for the period.',
+            'values': [
+                {'end_time': '2016-11-1{}T08:00:00+0000'.format(day),
+                 'value': random.randint(0, 100000)}
+                for day in (5, 6, 7)
+            ],
+        })
+    return json.dumps({
+        'data': data,
+        'paging': {
+            'previous': 'https://graph.facebook.com/v2.8/{}/insights/{}'
+                        '?since=1478937600&until=1479196800'.format(graph_id,
+                                                                    metric),
+            'next': 'https://graph.facebook.com/v2.8/{}/insights/{}'
+                    '?since=1479456000&until=1479715200'.format(graph_id,
+                                                                metric),
+        },
+    })
+
+
+def make_batch_response(graph_ids, metrics, periods, include_headers):
+    batch_response = []
+    for graph_id in graph_ids:
+        for metric in metrics:
+            response = {'code': 200,
+                        'body': make_body(graph_id, metric, periods)}
+            if include_headers:
+                response['headers'] = HEADERS
+            batch_response.append(response)
+    return json.dumps(batch_response).encode('utf-8')
+
+
+def gzip_size(payload):
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as gzip_file:
+        gzip_file.write(payload)
+    return len(buffer.getvalue())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-o', '--objects', type=int, default=1000,
+                        help='the number of pages (default: 1000)')
+    parser.add_argument('-m', '--metrics', type=int, default=4,
+                        help='the number of metrics per page (default: 4)')
+    args = parser.parse_args()
+
+    random.seed(0)
+    graph_ids = [str(random.randint(10 ** 14, 10 ** 15))
+                 for _ in range(args.objects)]
+    metrics = ['page_metric_{}'.format(i) for i in range(args.metrics)]
+    before = make_batch_response(graph_ids, metrics, PERIODS, True)
+    after = make_batch_response(graph_ids, metrics, ['day'], False)
+
+    row = '{:<34}{:>14}{:>14}'
+    print(row.format('', 'plain, bytes', 'gzip, bytes'))
+    print(row.format('all periods, include_headers=true',
+                     len(before), gzip_size(before)))
+    print(row.format('period=day, include_headers=false',
+                     len(after), gzip_size(after)))
+    print('Saved: {:.0%} plain, {:.0%} gzip'.format(
+        1 - float(len(after)) / len(before),
+        1 - float(gzip_size(after)) / gzip_size(before),
+    ))
+
+
+if __name__ == '__main__':
+    main()
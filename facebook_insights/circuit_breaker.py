@@ -0,0 +1,252 @@
+"""A circuit breaker around batch requests to Graph API.
+
+When Facebook is degraded, every request waits out its timeout and fails,
+so workers pile up and retries make things worse. The circuit breaker keeps
+track of failed and slow requests made with each access token during a
+rolling window. Once the share of either of them exceeds its threshold,
+the circuit opens, and requests fail immediately with CircuitOpen. After
+`open_timeout` seconds the circuit becomes half-open: a single probe
+request is let through, and the circuit closes, if the probe succeeds, or
+opens again otherwise.
+
+The breaker is configured with setting FACEBOOK_INSIGHTS_CIRCUIT_BREAKER
+(set it to None to disable the breaker):
+
+    FACEBOOK_INSIGHTS_CIRCUIT_BREAKER = {
+        'window': 60,               # seconds
+        'min_calls': 20,            # calls in the window to judge by
+        'failure_rate': 0.5,        # share of failed calls to open at
+        'slow_call_rate': 0.5,      # share of slow calls to open at
+        'slow_call_duration': 10,   # seconds
+        'open_timeout': 30,         # seconds before a probe
+        'cache': None,              # alias of a cache to share state in
+    }
+
+If 'cache' is set, the state of circuits is shared between processes
+through the Django cache: a circuit opened by one worker is open for all of
+them, and only one of them makes the probe request.
+
+Changes of the state are announced with signal 'circuit_state_changed'.
+
+"""
+import collections
+import hashlib
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.core.cache import caches
+from django.dispatch import Signal
+from facebook import GraphAPIError
+
+from facebook_insights.exceptions import CircuitOpen
+
+__all__ = ['CircuitBreaker', 'circuit_state_changed', 'get_circuit_breaker',
+           'CLOSED', 'OPEN', 'HALF_OPEN']
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Codes of errors that Graph API returns when it's unable to process
+# requests (unknown error and service unavailable).
+DEGRADATION_ERROR_CODES = frozenset([1, 2])
+
+DEFAULTS = {
+    'window': 60,
+    'min_calls': 20,
+    'failure_rate': 0.5,
+    'slow_call_rate': 0.5,
+    'slow_call_duration': 10,
+    'open_timeout': 30,
+    'cache': None,
+}
+
+circuit_state_changed = Signal()
+"""Sent when a circuit changes its state. Arguments: 'sender' - the
+CircuitBreaker instance, 'old_state' and 'new_state'.
+"""
+
+
+def is_failure(error):
+    """Check whether an exception indicates that Graph API is degraded.
+
+    Errors caused by the request itself (e.g. invalid parameters, missing
+    permissions or rate limiting) don't count as failures.
+    """
+    if isinstance(error, requests.RequestException):
+        return True
+    if isinstance(error, GraphAPIError):
+        result = error.result
+        if not isinstance(result, dict):
+            # facebook-sdk wasn't able to parse the response at all
+            return True
+        error_data = result.get('error')
+        if isinstance(error_data, dict):
+            return bool(error_data.get('is_transient') or
+                        error_data.get('code') in DEGRADATION_ERROR_CODES)
+    return False
+
+
+class CircuitBreaker(object):
+    """A circuit breaker for requests sharing the same key.
+
+    Parameters
+    ----------
+    key : str
+        The identifier of the circuit.
+    window, min_calls, failure_rate, slow_call_rate, slow_call_duration,
+    open_timeout, cache
+        See the module docstring.
+
+    """
+
+    def __init__(self, key, window=60, min_calls=20, failure_rate=0.5,
+                 slow_call_rate=0.5, slow_call_duration=10, open_timeout=30,
+                 cache=None):
+        self.key = key
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_rate = slow_call_rate
+        self.slow_call_duration = slow_call_duration
+        self.open_timeout = open_timeout
+        self.cache_alias = cache
+        # Tuples (finish time, failed, slow)
+        self._calls = collections.deque()
+        self._opened_at = None
+        self._probing = False
+        self._last_state = CLOSED
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @property
+    def cache_key(self):
+        return 'facebook_insights:circuit:{}'.format(self.key)
+
+    def _get_opened_at(self):
+        if self.cache_alias:
+            return self.cache.get(self.cache_key)
+        return self._opened_at
+
+    def _set_opened_at(self, opened_at):
+        if self.cache_alias:
+            if opened_at is None:
+                self.cache.delete(self.cache_key)
+            else:
+                # Keep the record a bit longer than the circuit is open,
+                # so that workers notice it's time to probe.
+                self.cache.set(self.cache_key, opened_at,
+                               self.open_timeout * 2)
+        self._opened_at = opened_at
+
+    @property
+    def state(self):
+        """str: The current state of the circuit."""
+        opened_at = self._get_opened_at()
+        if opened_at is None:
+            return CLOSED
+        if time.time() - opened_at < self.open_timeout:
+            return OPEN
+        return HALF_OPEN
+
+    def _acquire_probe(self):
+        """Make sure only one probe request is made at a time."""
+        if self.cache_alias:
+            return self.cache.add(self.cache_key + ':probe', True,
+                                  self.open_timeout)
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def _release_probe(self):
+        if self.cache_alias:
+            self.cache.delete(self.cache_key + ':probe')
+        self._probing = False
+
+    def _notify(self):
+        new_state = self.state
+        if new_state != self._last_state:
+            old_state, self._last_state = self._last_state, new_state
+            circuit_state_changed.send(sender=self, old_state=old_state,
+                                       new_state=new_state)
+
+    def _record(self, failed, duration):
+        now = time.time()
+        calls = self._calls
+        calls.append((now, failed, duration >= self.slow_call_duration))
+        while calls and calls[0][0] < now - self.window:
+            calls.popleft()
+        if len(calls) < self.min_calls:
+            return
+        failures = sum(1 for _, call_failed, _ in calls if call_failed)
+        slow_calls = sum(1 for _, _, slow in calls if slow)
+        if (failures >= self.failure_rate * len(calls) or
+                slow_calls >= self.slow_call_rate * len(calls)):
+            self._set_opened_at(now)
+            calls.clear()
+
+    def call(self, func, *args, **kwargs):
+        """Call a function making a request, unless the circuit is open.
+
+        Raises
+        ------
+        CircuitOpen
+            If the circuit is open or another probe request is in progress.
+
+        """
+        with self._lock:
+            self._notify()
+            state = self.state
+            if state == OPEN or (state == HALF_OPEN and
+                                 not self._acquire_probe()):
+                raise CircuitOpen(
+                    "The circuit '{}' is open.".format(self.key)
+                )
+        probe = state == HALF_OPEN
+        failed = False
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as error:
+            failed = is_failure(error)
+            raise
+        finally:
+            duration = time.time() - start
+            with self._lock:
+                if probe:
+                    self._release_probe()
+                    if failed or duration >= self.slow_call_duration:
+                        self._set_opened_at(time.time())
+                    else:
+                        self._set_opened_at(None)
+                else:
+                    self._record(failed, duration)
+                self._notify()
+        return result
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(access_token):
+    """Get the circuit breaker for requests made with a given token or None,
+    if the circuit breaker is disabled.
+    """
+    options = getattr(settings, 'FACEBOOK_INSIGHTS_CIRCUIT_BREAKER', DEFAULTS)
+    if options is None:
+        return None
+    # Tokens are secrets, so they shouldn't end up in cache keys.
+    key = hashlib.sha1(access_token.encode('utf-8')).hexdigest()[:16]
+    with _circuit_breakers_lock:
+        if key not in _circuit_breakers:
+            kwargs = dict(DEFAULTS)
+            kwargs.update(options)
+            _circuit_breakers[key] = CircuitBreaker(key, **kwargs)
+        return _circuit_breakers[key]
@@ -0,0 +1,248 @@
+"""Metrics derived from fetched ones, computed when metrics are fetched.
+
+Ratios and deltas are cheaper to compute once per fetch than on every read.
+Declare them on a model as expressions over fetched metrics and previous
+values of its fields, and store them in ordinary fields:
+
+    class PostInsights(Insights):
+        METRICS = ['post_stories', 'post_impressions_unique']
+        DERIVED_METRICS = {
+            'engagement_rate': (Fetched('post_stories') /
+                                Fetched('post_impressions_unique')),
+            'stories_change': Fetched('post_stories') - Previous('stories'),
+        }
+        ...
+        engagement_rate = models.FloatField(null=True)
+        stories_change = models.IntegerField(null=True)
+
+Expressions support +, -, * and / over Fetched(), Previous() and numbers:
+
+* Fetched(metric, period=None, index=-1) is the value of a fetched metric,
+  as returned by Metric.get_value(period, index, extract=True). Use index=-2
+  to get the value of the previous day out of the 3-day window of page
+  metrics.
+* Previous(field_name) is the value of a field before the fetch.
+
+Expressions are evaluated once per fetch for all the fetched objects of a
+model: each operation is applied to whole columns of values. If an operand
+is missing (e.g. the metric failed to be fetched) or isn't a number, or the
+divisor is zero, the field is left untouched.
+
+"""
+import operator
+from numbers import Number
+
+__all__ = ['Fetched', 'Previous', 'set_metrics_bulk']
+
+
+def _get_number(value):
+    if isinstance(value, Number) and not isinstance(value, bool):
+        return value
+    return None
+
+
+class Expression(object):
+    """The base class of expressions computing derived metrics."""
+
+    def evaluate(self, columns, size):
+        """Compute values of the expression for a number of objects.
+
+        Parameters
+        ----------
+        columns : dict
+            Mappings of keys of leaf expressions to lists of their values.
+        size : int
+            The number of objects.
+
+        Returns
+        -------
+        list
+            Numbers or None for every object.
+
+        """
+        raise NotImplementedError
+
+    def get_leaves(self):
+        """Get the expressions values are read for (Fetched, Previous)."""
+        return []
+
+    def _combine(self, function, symbol, left, right):
+        return BinaryOperation(function, symbol, _to_expression(left),
+                               _to_expression(right))
+
+    def __add__(self, other):
+        return self._combine(operator.add, '+', self, other)
+
+    def __radd__(self, other):
+        return self._combine(operator.add, '+', other, self)
+
+    def __sub__(self, other):
+        return self._combine(operator.sub, '-', self, other)
+
+    def __rsub__(self, other):
+        return self._combine(operator.sub, '-', other, self)
+
+    def __mul__(self, other):
+        return self._combine(operator.mul, '*', self, other)
+
+    def __rmul__(self, other):
+        return self._combine(operator.mul, '*', other, self)
+
+    def __truediv__(self, other):
+        return self._combine(operator.truediv, '/', self, other)
+
+    def __rtruediv__(self, other):
+        return self._combine(operator.truediv, '/', other, self)
+
+    __div__ = __truediv__  # Python 2
+    __rdiv__ = __rtruediv__
+
+
+def _to_expression(value):
+    if isinstance(value, Expression):
+        return value
+    return Constant(value)
+
+
+class Constant(Expression):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return repr(self.value)
+
+    def evaluate(self, columns, size):
+        return [self.value] * size
+
+
+class Fetched(Expression):
+    """The value of a fetched metric (see Metric.get_value())."""
+
+    def __init__(self, metric, period=None, index=-1):
+        self.metric = metric
+        self.period = period
+        self.index = index
+        self.key = ('fetched', metric, period, index)
+
+    def __repr__(self):
+        if self.period is None and self.index == -1:
+            return "Fetched({!r})".format(self.metric)
+        return "Fetched({!r}, {!r}, {!r})".format(self.metric, self.period,
+                                                  self.index)
+
+    def read(self, metrics):
+        """Read the value out of the fetched metrics of an object."""
+        metric = metrics.get(self.metric)
+        if metric is None:
+            return None
+        try:
+            value = metric.get_value(self.period, self.index, extract=True)
+        except (KeyError, IndexError, TypeError):
+            return None
+        return _get_number(value)
+
+    def evaluate(self, columns, size):
+        return columns[self.key]
+
+    def get_leaves(self):
+        return [self]
+
+
+class Previous(Expression):
+    """The value of a field before the fetch."""
+
+    def __init__(self, field_name):
+        self.field_name = field_name
+        self.key = ('previous', field_name)
+
+    def __repr__(self):
+        return "Previous({!r})".format(self.field_name)
+
+    def read(self, instance):
+        """Read the value out of an instance."""
+        try:
+            value = instance.get_decoded_value(self.field_name)
+        except ValueError:
+            return None
+        return _get_number(value)
+
+    def evaluate(self, columns, size):
+        return columns[self.key]
+
+    def get_leaves(self):
+        return [self]
+
+
+class BinaryOperation(Expression):
+
+    def __init__(self, function, symbol, left, right):
+        self.function = function
+        self.symbol = symbol
+        self.left = left
+        self.right = right
+
+    def __repr__(self):
+        return '({!r} {} {!r})'.format(self.left, self.symbol, self.right)
+
+    def evaluate(self, columns, size):
+        function = self.function
+        results = []
+        for left, right in zip(self.left.evaluate(columns, size),
+                               self.right.evaluate(columns, size)):
+            if left is None or right is None:
+                results.append(None)
+                continue
+            try:
+                results.append(function(left, right))
+            except ZeroDivisionError:
+                results.append(None)
+        return results
+
+    def get_leaves(self):
+        return self.left.get_leaves() + self.right.get_leaves()
+
+
+def set_metrics_bulk(instances, metrics_list):
+    """Put fetched metrics into fields of instances of the same model and
+    compute the model's derived metrics for all of them at once.
+
+    Parameters
+    ----------
+    instances : list of Insights
+    metrics_list : list of dict
+        Fetched metrics of each instance (see Insights.set_metrics()).
+
+    """
+    if not instances:
+        return
+    derived_metrics = instances[0].DERIVED_METRICS
+    if not derived_metrics:
+        for instance, metrics in zip(instances, metrics_list):
+            instance.set_metrics(metrics)
+        return
+    leaves = dict(
+        (leaf.key, leaf)
+        for expression in derived_metrics.values()
+        for leaf in expression.get_leaves()
+    )
+    columns = {}
+    # Previous values are read before they're overwritten
+    for key, leaf in leaves.items():
+        if isinstance(leaf, Previous):
+            columns[key] = [leaf.read(instance) for instance in instances]
+    for instance, metrics in zip(instances, metrics_list):
+        instance.set_metrics(metrics)
+    for key, leaf in leaves.items():
+        if isinstance(leaf, Fetched):
+            columns[key] = [leaf.read(metrics) for metrics in metrics_list]
+    for field_name, expression in sorted(derived_metrics.items()):
+        if field_name not in instances[0]._all_field_names:
+            raise AttributeError(
+                "Can't find field '{}' for a derived metric."
+                "".format(field_name)
+            )
+        values = expression.evaluate(columns, len(instances))
+        for instance, value in zip(instances, values):
+            if value is not None:
+                setattr(instance, field_name, value)
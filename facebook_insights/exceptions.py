@@ -1,4 +1,5 @@
-__all__ = ['MetricsNotSpecified', 'EmptyData', 'MissingField']
+__all__ = ['MetricsNotSpecified', 'EmptyData', 'MissingField', 'NoAccessToken',
+           'CircuitOpen']
 
 
 class InsightsException(Exception):
@@ -21,3 +22,15 @@ class EmptyData(InsightsException):
 
 class MissingField(InsightsException):
     """The model doesn't define a field for one of requested metrics."""
+
+
+class NoAccessToken(InsightsException):
+    """None of the configured access tokens can be used to make a request,
+    because all of them are either expired or throttled.
+    """
+
+
+class CircuitOpen(InsightsException):
+    """Requests to Facebook are not made, because recent requests have been
+    failing or timing out (see module 'circuit_breaker').
+    """
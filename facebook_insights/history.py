@@ -0,0 +1,351 @@
+"""Tools to keep the history of metric values.
+
+Models with KEEP_HISTORY = True record every fetched value into model
+'MetricValue' in addition to storing the latest values in their own fields.
+
+On PostgreSQL (11 or newer), the history table is partitioned by month of
+'end_time': partitions are created on demand when values are recorded, and
+expired history is removed by dropping whole partitions rather than with
+huge DELETEs. On other backends, the history is kept in a plain table.
+
+Old history can be downsampled to lower resolutions with the
+'insights_retention' management command (see downsample() and
+drop_expired()).
+
+"""
+import operator
+from datetime import datetime, timedelta
+from functools import reduce
+from itertools import groupby
+
+from django.db import connections, migrations, router, transaction
+from django.db.models import Q
+from django.utils import six, timezone
+from django.utils.dateparse import parse_datetime
+
+from facebook_insights.json_codec import codec
+
+__all__ = ['CreatePartitionedModel', 'DAY', 'WEEK', 'MONTH',
+           'record_metrics', 'ensure_partitions', 'downsample',
+           'drop_expired']
+
+DAY = 'day'
+WEEK = 'week'
+MONTH = 'month'
+
+RESOLUTIONS = [DAY, WEEK, MONTH]
+
+# Periods for which values of consecutive days add up. Values of all other
+# periods (e.g. 'week', 'days_28', 'lifetime') are rolling or cumulative, so
+# the last value is kept when they're downsampled.
+SUMMABLE_PERIODS = frozenset(['day'])
+
+_known_partitions = set()
+
+
+def is_partitioned(connection):
+    return connection.vendor == 'postgresql'
+
+
+def get_month_start(moment):
+    # Partitions are aligned to months in UTC
+    if timezone.is_aware(moment):
+        moment = moment.astimezone(timezone.utc)
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def get_next_month_start(moment):
+    month_start = get_month_start(moment)
+    return get_month_start(month_start + timedelta(days=32))
+
+
+def get_bucket_start(moment, resolution):
+    """Get the start of the week or month the moment belongs to."""
+    if resolution == MONTH:
+        return get_month_start(moment)
+    if timezone.is_aware(moment):
+        moment = moment.astimezone(timezone.utc)
+    day_start = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    return day_start - timedelta(days=day_start.weekday())
+
+
+def get_partition_name(table, month_start):
+    return '{}_y{:04d}m{:02d}'.format(table, month_start.year,
+                                      month_start.month)
+
+
+class CreatePartitionedModel(migrations.CreateModel):
+    """Create a model whose table is partitioned by range of a field on
+    PostgreSQL, and a plain table on other backends.
+
+    PostgreSQL requires the partition key to be a part of the primary key,
+    so the primary key of the table consists of the model's primary key
+    and the partition key.
+    """
+
+    def __init__(self, name, fields, partition_key, **kwargs):
+        super(CreatePartitionedModel, self).__init__(name, fields, **kwargs)
+        self.partition_key = partition_key
+
+    def deconstruct(self):
+        name, args, kwargs = super(CreatePartitionedModel, self).deconstruct()
+        kwargs['partition_key'] = self.partition_key
+        return name, args, kwargs
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        connection = schema_editor.connection
+        if not is_partitioned(connection):
+            return super(CreatePartitionedModel, self).database_forwards(
+                app_label, schema_editor, from_state, to_state,
+            )
+        model = to_state.apps.get_model(app_label, self.name)
+        if not self.allow_migrate_model(connection.alias, model):
+            return
+        quote_name = schema_editor.quote_name
+        table = model._meta.db_table
+        columns = []
+        indexed_columns = []
+        for field in model._meta.local_fields:
+            definition = '{} {}'.format(quote_name(field.column),
+                                        field.db_type(connection))
+            definition += ' NULL' if field.null else ' NOT NULL'
+            if field.is_relation:
+                related_meta = field.related_model._meta
+                definition += ' REFERENCES {} ({}) DEFERRABLE INITIALLY ' \
+                              'DEFERRED'.format(
+                                  quote_name(related_meta.db_table),
+                                  quote_name(related_meta.pk.column),
+                              )
+                indexed_columns.append(field.column)
+            columns.append(definition)
+        partition_column = model._meta.get_field(self.partition_key).column
+        columns.append('PRIMARY KEY ({}, {})'.format(
+            quote_name(model._meta.pk.column),
+            quote_name(partition_column),
+        ))
+        schema_editor.execute(
+            'CREATE TABLE {} ({}) PARTITION BY RANGE ({})'.format(
+                quote_name(table),
+                ', '.join(columns),
+                quote_name(partition_column),
+            )
+        )
+        for column in indexed_columns:
+            schema_editor.execute('CREATE INDEX {} ON {} ({})'.format(
+                quote_name('{}_{}_idx'.format(table, column)),
+                quote_name(table),
+                quote_name(column),
+            ))
+
+
+def ensure_partitions(model, moments, using):
+    """Create monthly partitions for moments, if they don't exist yet."""
+    connection = connections[using]
+    if not is_partitioned(connection):
+        return
+    table = model._meta.db_table
+    quote_name = connection.ops.quote_name
+    month_starts = set(get_month_start(moment) for moment in moments)
+    with connection.cursor() as cursor:
+        for month_start in sorted(month_starts):
+            partition = get_partition_name(table, month_start)
+            if (using, partition) in _known_partitions:
+                continue
+            cursor.execute(
+                'CREATE TABLE IF NOT EXISTS {} PARTITION OF {} '
+                'FOR VALUES FROM (%s) TO (%s)'.format(quote_name(partition),
+                                                       quote_name(table)),
+                [month_start, get_next_month_start(month_start)],
+            )
+            _known_partitions.add((using, partition))
+
+
+def record_metrics(instance, metrics, fetched_at=None):
+    """Record fetched values of an instance's metrics into the history.
+
+    Values already in the history are overwritten.
+
+    Parameters
+    ----------
+    instance : Insights
+        A saved instance.
+    metrics : dict
+        A mapping of metric names to instances of class 'Metric'.
+    fetched_at : datetime.datetime
+        The time of the fetch, used as 'end_time' of values that don't
+        have one (e.g. lifetime values of post metrics). Defaults to the
+        current time.
+
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from facebook_insights.models import MetricValue
+
+    fetched_at = fetched_at or timezone.now()
+    content_type = ContentType.objects.get_for_model(instance)
+    object_id = str(instance.pk)
+    rows = {}
+    for metric in metrics.values():
+        for period, values in metric.values.items():
+            for item in values:
+                end_time = fetched_at
+                if item.get('end_time'):
+                    end_time = parse_datetime(item['end_time'])
+                value = item.get('value')
+                row = MetricValue(
+                    content_type=content_type,
+                    object_id=object_id,
+                    metric=metric.name,
+                    period=period,
+                    resolution=DAY,
+                    end_time=end_time,
+                )
+                if (isinstance(value, six.integer_types) and
+                        not isinstance(value, bool)):
+                    row.value = value
+                else:
+                    row.data = codec.dumps(value)
+                rows[(metric.name, period, end_time)] = row
+    if not rows:
+        return
+    using = router.db_for_write(MetricValue, instance=instance)
+    ensure_partitions(MetricValue, [key[2] for key in rows], using)
+    with transaction.atomic(using=using):
+        existing_rows = reduce(operator.or_, [
+            Q(metric=metric, period=period, end_time=end_time)
+            for metric, period, end_time in rows
+        ])
+        MetricValue.objects.using(using).filter(
+            existing_rows,
+            content_type=content_type,
+            object_id=object_id,
+            resolution=DAY,
+        ).delete()
+        MetricValue.objects.using(using).bulk_create(list(rows.values()))
+
+
+def _aggregate(key, bucket_rows):
+    """Merge rows of the same object, metric and period falling into the
+    same bucket into one.
+    """
+    from facebook_insights.models import MetricValue
+
+    content_type_id, object_id, metric, period = key
+    last_row = bucket_rows[-1]
+    value = last_row.value
+    if period in SUMMABLE_PERIODS and last_row.value is not None:
+        value = sum(row.value or 0 for row in bucket_rows)
+    return MetricValue(
+        content_type_id=content_type_id,
+        object_id=object_id,
+        metric=metric,
+        period=period,
+        end_time=last_row.end_time,
+        value=value,
+        data=last_row.data,
+    )
+
+
+def downsample(from_resolution, to_resolution, before, using='default',
+               batch_size=1000):
+    """Merge old values into values of a lower resolution.
+
+    Values of periods listed in SUMMABLE_PERIODS are summed up, for other
+    periods the last value of each week or month is kept.
+
+    Parameters
+    ----------
+    from_resolution : {'day', 'week'}
+    to_resolution : {'week', 'month'}
+    before : datetime.datetime
+        Values with 'end_time' before the start of the week or month this
+        moment belongs to are downsampled.
+    using : str
+        The database alias.
+    batch_size : int
+        The number of new rows to insert at once.
+
+    Returns
+    -------
+    tuple
+        The numbers of removed and created rows.
+
+    """
+    from facebook_insights.models import MetricValue
+
+    before = get_bucket_start(before, to_resolution)
+    old_rows = MetricValue.objects.using(using).filter(
+        resolution=from_resolution,
+        end_time__lt=before,
+    )
+
+    def get_key(row):
+        return (row.content_type_id, row.object_id, row.metric, row.period,
+                get_bucket_start(row.end_time, to_resolution))
+
+    created = 0
+    with transaction.atomic(using=using):
+        new_rows = []
+        ordered_rows = old_rows.order_by('content_type', 'object_id',
+                                         'metric', 'period', 'end_time')
+        for key, bucket_rows in groupby(ordered_rows.iterator(), get_key):
+            new_row = _aggregate(key[:4], list(bucket_rows))
+            new_row.resolution = to_resolution
+            new_rows.append(new_row)
+            if len(new_rows) >= batch_size:
+                MetricValue.objects.using(using).bulk_create(new_rows)
+                created += len(new_rows)
+                new_rows = []
+        if new_rows:
+            MetricValue.objects.using(using).bulk_create(new_rows)
+            created += len(new_rows)
+        removed = old_rows.count()
+        old_rows.delete()
+    return removed, created
+
+
+def drop_expired(before, using='default'):
+    """Remove values with 'end_time' earlier than a given moment.
+
+    On PostgreSQL, partitions lying entirely before the moment are dropped,
+    and only the rest is deleted row by row.
+
+    Returns
+    -------
+    list of str
+        Names of dropped partitions.
+
+    """
+    from facebook_insights.models import MetricValue
+
+    connection = connections[using]
+    dropped = []
+    if is_partitioned(connection):
+        table = MetricValue._meta.db_table
+        quote_name = connection.ops.quote_name
+        first_kept_month = get_month_start(before)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT child.relname FROM pg_inherits '
+                'JOIN pg_class parent ON pg_inherits.inhparent = parent.oid '
+                'JOIN pg_class child ON pg_inherits.inhrelid = child.oid '
+                'WHERE parent.relname = %s',
+                [table],
+            )
+            partitions = [row[0] for row in cursor.fetchall()]
+            for partition in sorted(partitions):
+                suffix = partition[len(table):]
+                try:
+                    month_start = datetime.strptime(suffix, '_y%Ym%m')
+                except ValueError:
+                    continue
+                if timezone.is_aware(first_kept_month):
+                    month_start = timezone.make_aware(month_start,
+                                                      timezone.utc)
+                if month_start >= first_kept_month:
+                    continue
+                cursor.execute('DROP TABLE {}'.format(quote_name(partition)))
+                _known_partitions.discard((using, partition))
+                dropped.append(partition)
+    MetricValue.objects.using(using).filter(end_time__lt=before).delete()
+    return dropped
@@ -0,0 +1,74 @@
+"""The JSON codec used to parse responses and serialize field values.
+
+The codec is chosen with setting FACEBOOK_INSIGHTS_JSON_CODEC:
+
+* 'json' - the standard library module;
+* 'orjson' - the orjson_ package, which is several times faster;
+* the dotted path to any object having functions 'loads' and 'dumps' with
+  the same signatures as those of the standard library module ('dumps'
+  must return str).
+
+If the setting is not specified, orjson is used when it's installed, and the
+standard library module otherwise.
+
+.. _orjson: https://github.com/ijl/orjson
+
+"""
+import json
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+__all__ = ['JSONCodec', 'OrjsonCodec', 'get_codec', 'codec']
+
+
+class JSONCodec(object):
+    """A codec based on the standard library module 'json'."""
+    name = 'json'
+
+    @staticmethod
+    def loads(string):
+        return json.loads(string)
+
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj)
+
+
+class OrjsonCodec(object):
+    """A codec based on package 'orjson'."""
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def loads(self, string):
+        return self._orjson.loads(string)
+
+    def dumps(self, obj):
+        return self._orjson.dumps(obj).decode('utf-8')
+
+
+def get_codec(name=None):
+    """Get a codec by its name or dotted path (see the module docstring)."""
+    if name is None:
+        try:
+            return OrjsonCodec()
+        except ImportError:
+            return JSONCodec()
+    if name == 'json':
+        return JSONCodec()
+    if name == 'orjson':
+        try:
+            return OrjsonCodec()
+        except ImportError:
+            raise ImproperlyConfigured(
+                "FACEBOOK_INSIGHTS_JSON_CODEC is set to 'orjson', but the "
+                "package is not installed."
+            )
+    return import_string(name)
+
+
+codec = get_codec(getattr(settings, 'FACEBOOK_INSIGHTS_JSON_CODEC', None))
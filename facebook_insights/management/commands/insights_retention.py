@@ -0,0 +1,62 @@
+"""Downsample and remove old metric history (see module 'history')."""
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+
+from facebook_insights.history import (DAY, MONTH, WEEK, downsample,
+                                       drop_expired)
+
+
+class Command(BaseCommand):
+    help = (
+        'Downsample old daily values of metric history to weekly and old '
+        'weekly values to monthly, and remove expired history.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--daily', type=int, default=90, metavar='DAYS',
+            help='keep daily values for DAYS days (default: 90)',
+        )
+        parser.add_argument(
+            '--weekly', type=int, default=365, metavar='DAYS',
+            help='keep weekly values for DAYS days (default: 365)',
+        )
+        parser.add_argument(
+            '--keep', type=int, default=None, metavar='DAYS',
+            help='remove all values older than DAYS days (default: keep '
+                 'monthly values forever)',
+        )
+        parser.add_argument(
+            '--database', default=DEFAULT_DB_ALIAS,
+            help='the database to process (default: "default")',
+        )
+
+    def handle(self, *args, **options):
+        daily = options['daily']
+        weekly = options['weekly']
+        keep = options['keep']
+        if weekly < daily:
+            raise CommandError('--weekly must not be less than --daily.')
+        if keep is not None and keep < weekly:
+            raise CommandError('--keep must not be less than --weekly.')
+        using = options['database']
+        now = timezone.now()
+        if keep is not None:
+            dropped = drop_expired(now - timedelta(days=keep), using)
+            for partition in dropped:
+                self.stdout.write('Dropped partition {}'.format(partition))
+        steps = [
+            (DAY, WEEK, now - timedelta(days=daily)),
+            (WEEK, MONTH, now - timedelta(days=weekly)),
+        ]
+        for from_resolution, to_resolution, before in steps:
+            removed, created = downsample(from_resolution, to_resolution,
+                                          before, using)
+            self.stdout.write(
+                'Downsampled {} {} values into {} {} values'.format(
+                    removed, from_resolution, created, to_resolution,
+                )
+            )
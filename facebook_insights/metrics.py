@@ -39,29 +39,66 @@
 {'day': 0, 'week': 10, 'days_28': 100}
 
 """
-import json
+import logging
+import threading
 
 from django.conf import settings
+from django.utils.six.moves.urllib.parse import urlencode
 from facebook import GraphAPI, GraphAPIError
 
-from facebook_insights.exceptions import EmptyData, MetricsNotSpecified
+from facebook_insights.circuit_breaker import get_circuit_breaker
+from facebook_insights.exceptions import (EmptyData, MetricsNotSpecified,
+                                          NoAccessToken)
+from facebook_insights.json_codec import codec
+from facebook_insights.negative_cache import is_permanent_error, negative_cache
+from facebook_insights.profiling import phase
+from facebook_insights.tokens import token_provider
 
-__all__ = ['fetch_metrics', 'Metric']
+__all__ = ['fetch_metrics', 'fetch_metrics_bulk', 'fetch_metrics_by_id',
+           'explain_fetch', 'FetchPlan', 'Metric']
+
+logger = logging.getLogger(__name__)
 
-access_token = settings.FACEBOOK_INSIGHTS_ACCESS_TOKEN
 api_version = getattr(settings, 'FACEBOOK_INSIGHTS_API_VERSION', None)
-graph_api = GraphAPI(access_token=access_token, version=api_version)
+# Graph API doesn't accept more than 50 requests in a single batch
+batch_size = getattr(settings, 'FACEBOOK_INSIGHTS_BATCH_SIZE', 50)
+
+_graph_apis = {}
+_graph_apis_lock = threading.Lock()
+
+
+def get_graph_api(access_token):
+    """Get a GraphAPI instance making requests with the given token."""
+    with _graph_apis_lock:
+        if access_token not in _graph_apis:
+            _graph_apis[access_token] = GraphAPI(access_token=access_token,
+                                                 version=api_version)
+        return _graph_apis[access_token]
+
+
+def prefetch_tokens(graph_ids):
+    """Load access tokens of the objects on the current thread, so that their
+    metrics can be fetched by another one (see BaseTokenProvider.prefetch()).
+    """
+    return token_provider.prefetch(graph_ids)
 
 
-def fetch_metrics(graph_id, metrics):
+def fetch_metrics(graph_id, metrics, periods=None):
     """Fetch Facebook Insights metrics for an object with a given id.
 
+    Metrics that are in the negative cache (see module 'negative_cache')
+    are not requested and thus are missing from the return value.
+
     Parameters
     ----------
     graph_id : str
         The Facebook ID of a Graph API object.
     metrics : iterable of str
         The object's metrics to fetch (e.g. 'page_engaged_users').
+    periods : dict
+        Mappings of metric names to periods ('day', 'week', 'days_28',
+        'lifetime') the metrics should be fetched for. Metrics that are
+        not listed are fetched for all available periods.
 
     Returns
     -------
@@ -69,41 +106,351 @@ def fetch_metrics(graph_id, metrics):
         A dictionary of mappings between metric names and instances
         of class 'Metric'.
 
+    Raises
+    ------
+    EmptyData
+        If the data for one of the metrics is empty or all the metrics are
+        in the negative cache.
+    GraphAPIError
+        If Facebook responds with an error to one of the requests.
+
     """
     if not metrics:
         raise MetricsNotSpecified('Specify metrics you want to fetch.')
-    batch = []
-    for metric in metrics:
-        request_data = {
-            'method': 'GET',
-            'relative_url': '{}/insights/{}/'.format(graph_id, metric)
-        }
-        batch.append(request_data)
-    batch_response = graph_api.put_object(
-        parent_object='/',
-        connection_name='',
-        batch=json.dumps(batch),
+    metrics = negative_cache.filter(graph_id, list(metrics))
+    if not metrics:
+        raise EmptyData
+    extracted_metrics, errors = _fetch([(graph_id, metrics)], periods)
+    # Errors are raised only after the whole batch is processed, so that
+    # every failed metric gets into the negative cache during the same run.
+    if errors:
+        raise errors[graph_id][0]
+    return extracted_metrics[graph_id]
+
+
+def fetch_metrics_bulk(graph_ids, metrics, periods=None):
+    """Fetch Facebook Insights metrics for several objects.
+
+    Requests for all the objects are packed into as few batches as possible.
+    Unlike fetch_metrics(), this function doesn't raise, if some of the
+    requests fail: errors are logged, and the failed metrics are missing from
+    the return value.
+
+    Parameters
+    ----------
+    graph_ids : iterable of str
+        The Facebook IDs of Graph API objects.
+    metrics : iterable of str
+        The metrics to fetch for each of the objects.
+    periods : dict
+        Same as for fetch_metrics().
+
+    Returns
+    -------
+    dict
+        A mapping of graph IDs to dictionaries of the same format as the one
+        returned by fetch_metrics().
+
+    """
+    if not metrics:
+        raise MetricsNotSpecified('Specify metrics you want to fetch.')
+    metrics = list(metrics)
+    return fetch_metrics_by_id(
+        [(graph_id, metrics) for graph_id in graph_ids], periods,
+    )
+
+
+def fetch_metrics_by_id(metrics_by_id, periods=None):
+    """Fetch different metrics for several objects.
+
+    Same as fetch_metrics_bulk(), but each object gets its own list of
+    metrics.
+
+    Parameters
+    ----------
+    metrics_by_id : iterable of tuple
+        Pairs of graph IDs and iterables of metrics.
+    periods : dict
+        Same as for fetch_metrics().
+
+    Returns
+    -------
+    dict
+        Same as for fetch_metrics_bulk().
+
+    """
+    metrics_by_id = negative_cache.filter_many(
+        [(graph_id, list(metrics)) for graph_id, metrics in metrics_by_id]
     )
-    extracted_metrics = {}
-    for response in batch_response:
-        body = json.loads(response['body'])
-        # (nevimov/2016-11-09): Currently facebook-sdk is not
-        # able to catch errors in responses to batch requests, so
-        # we have to take care of those ourselves.
-        if 'error' in body:
-            raise GraphAPIError(body)
-        data = body['data']
-        if not data:
-            raise EmptyData
-        rearranged_values = {}
-        for datum in data:
-            name = datum['name']
-            period = datum['period']
-            rearranged_values[period] = datum['values']
-        extracted_metrics[name] = Metric(name, rearranged_values)
+    extracted_metrics, errors = _fetch(metrics_by_id, periods)
+    for graph_id, object_errors in errors.items():
+        for error in object_errors:
+            logger.warning("Failed to fetch metrics of object '%s': %r",
+                           graph_id, error)
     return extracted_metrics
 
 
+def explain_fetch(graph_ids, metrics, periods=None):
+    """Plan the requests fetch_metrics_bulk() would make without making them.
+
+    Parameters
+    ----------
+    graph_ids, metrics, periods
+        Same as for fetch_metrics_bulk().
+
+    Returns
+    -------
+    FetchPlan
+
+    """
+    if not metrics:
+        raise MetricsNotSpecified('Specify metrics you want to fetch.')
+    metrics = list(metrics)
+    all_metrics_by_id = [(graph_id, metrics) for graph_id in graph_ids]
+    metrics_by_id = negative_cache.filter_many(all_metrics_by_id)
+    requests = _get_requests(metrics_by_id)
+    tokens = None
+    if requests:
+        try:
+            tokens = len(set(token_provider.get_tokens(
+                [graph_id for graph_id, _ in metrics_by_id]
+            ).values()))
+        except NoAccessToken:
+            tokens = 0
+    return FetchPlan(
+        objects=len(set(graph_id for graph_id, _ in metrics_by_id)),
+        requests=len(requests),
+        batches=len(list(_iter_batches(requests))),
+        negative_cache_hits=(len(all_metrics_by_id) * len(metrics) -
+                             len(requests)),
+        tokens=tokens,
+    )
+
+
+class FetchPlan(object):
+    """The requests a fetch would make (see explain_fetch()).
+
+    Attributes
+    ----------
+    objects : int
+        The number of distinct objects that would be requested.
+    requests : int
+        The number of requests (i.e. object-metric pairs) in all batches.
+        Graph API counts each request in a batch as a separate call, so this
+        is also the expected rate limit cost of the fetch.
+    batches : int
+        The number of batch requests, i.e. HTTP round trips.
+    negative_cache_hits : int
+        The number of requests skipped thanks to the negative cache.
+    tokens : int or None
+        The number of distinct access tokens the requests would be spread
+        across. None, if no requests would be made.
+
+    """
+
+    def __init__(self, objects=0, requests=0, batches=0,
+                 negative_cache_hits=0, tokens=None):
+        self.objects = objects
+        self.requests = requests
+        self.batches = batches
+        self.negative_cache_hits = negative_cache_hits
+        self.tokens = tokens
+
+    @property
+    def cost(self):
+        """int: The expected rate limit cost of the fetch."""
+        return self.requests
+
+    def as_dict(self):
+        return {
+            'objects': self.objects,
+            'requests': self.requests,
+            'batches': self.batches,
+            'negative_cache_hits': self.negative_cache_hits,
+            'tokens': self.tokens,
+            'cost': self.cost,
+        }
+
+    def __add__(self, other):
+        tokens = [plan.tokens for plan in (self, other)
+                  if plan.tokens is not None]
+        return FetchPlan(
+            objects=self.objects + other.objects,
+            requests=self.requests + other.requests,
+            batches=self.batches + other.batches,
+            negative_cache_hits=(self.negative_cache_hits +
+                                 other.negative_cache_hits),
+            tokens=max(tokens) if tokens else None,
+        )
+
+    def __repr__(self):
+        return (
+            '<FetchPlan: {objects} objects, {requests} requests in '
+            '{batches} batches, {negative_cache_hits} negative cache hits, '
+            '{tokens} tokens>'.format(**self.as_dict())
+        )
+
+
+def _get_requests(metrics_by_id):
+    """Flatten pairs of graph IDs and lists of metrics into pairs of graph
+    IDs and metrics.
+    """
+    return [(graph_id, metric)
+            for graph_id, metrics in metrics_by_id
+            for metric in metrics]
+
+
+def _iter_batches(requests):
+    """Split requests into batches of the maximum allowed size."""
+    for start in range(0, len(requests), batch_size):
+        yield requests[start:start + batch_size]
+
+
+def _fetch(metrics_by_id, periods=None):
+    """Fetch metrics packing requests into batches.
+
+    Parameters
+    ----------
+    metrics_by_id : list of tuple
+        Pairs of graph IDs and lists of metrics.
+    periods : dict
+        Mappings of metric names to periods.
+
+    Returns
+    -------
+    tuple
+        A mapping of graph IDs to dictionaries of fetched metrics (see
+        fetch_metrics()) and a mapping of graph IDs to lists of errors.
+
+    """
+    requests = _get_requests(metrics_by_id)
+    extracted_metrics = dict((graph_id, {}) for graph_id, _ in metrics_by_id)
+    errors = {}
+    for batch_requests in _iter_batches(requests):
+        batch_response = _request_batch(batch_requests, periods)
+        with phase('parse'):
+            for (graph_id, metric), response in zip(batch_requests,
+                                                     batch_response):
+                try:
+                    extracted_metric = _extract_metric(graph_id, metric,
+                                                       response)
+                except (EmptyData, GraphAPIError) as error:
+                    errors.setdefault(graph_id, []).append(error)
+                else:
+                    extracted_metrics[graph_id][extracted_metric.name] = (
+                        extracted_metric
+                    )
+    return extracted_metrics, errors
+
+
+def _request_batch(requests, periods=None):
+    """Make a batch request to Graph API.
+
+    Each object's requests are made with the token provided for the object.
+    If the token the batch itself is made with turns out to be throttled or
+    expired, the batch is retried with tokens the provider gives instead.
+    The request goes through the token's circuit breaker, so CircuitOpen is
+    raised without making a request while Graph API is failing.
+
+    Parameters
+    ----------
+    requests : list of tuple
+        Pairs of graph IDs and metrics.
+    periods : dict
+        Mappings of metric names to periods.
+
+    Returns
+    -------
+    list
+        Responses to the requests in the same order.
+
+    """
+    graph_ids = set(graph_id for graph_id, _ in requests)
+    while True:
+        tokens = token_provider.get_tokens(graph_ids)
+        batch_token = tokens[requests[0][0]]
+        batch = []
+        for graph_id, metric in requests:
+            params = {}
+            if periods and metric in periods:
+                params['period'] = periods[metric]
+            if tokens[graph_id] != batch_token:
+                params['access_token'] = tokens[graph_id]
+            relative_url = '{}/insights/{}/'.format(graph_id, metric)
+            if params:
+                relative_url += '?' + urlencode(sorted(params.items()))
+            batch.append({'method': 'GET', 'relative_url': relative_url})
+        request_kwargs = {
+            'parent_object': '/',
+            'connection_name': '',
+            'batch': codec.dumps(batch),
+            # Headers of individual responses are of no use to us, but
+            # make up a noticeable part of the payload.
+            'include_headers': 'false',
+        }
+        put_object = get_graph_api(batch_token).put_object
+        circuit_breaker = get_circuit_breaker(batch_token)
+        try:
+            with phase('fetch'):
+                if circuit_breaker:
+                    batch_response = circuit_breaker.call(put_object,
+                                                          **request_kwargs)
+                else:
+                    batch_response = put_object(**request_kwargs)
+        except GraphAPIError as error:
+            if not token_provider.report_error(batch_token,
+                                               _get_error(error)):
+                raise
+            continue
+        # Let the provider know about tokens that failed individual requests
+        for (graph_id, _), response in zip(requests, batch_response):
+            if response and '"error"' in response['body']:
+                error = codec.loads(response['body']).get('error', {})
+                token_provider.report_error(tokens[graph_id], error)
+        return batch_response
+
+
+def _extract_metric(graph_id, metric, response):
+    """Create an instance of 'Metric' from a response to a batch request.
+
+    Metrics failing with empty data or a permanent error are put into the
+    negative cache.
+    """
+    if response is None:
+        # Graph API returns null for requests of a batch it didn't complete
+        # (e.g. because of a timeout). They may succeed next time.
+        raise GraphAPIError({'error': {
+            'message': 'The request was not completed.',
+            'is_transient': True,
+        }})
+    body = codec.loads(response['body'])
+    # (nevimov/2016-11-09): Currently facebook-sdk is not
+    # able to catch errors in responses to batch requests, so
+    # we have to take care of those ourselves.
+    if 'error' in body:
+        if is_permanent_error(body['error']):
+            negative_cache.add(graph_id, metric)
+        raise GraphAPIError(body)
+    data = body['data']
+    if not data:
+        negative_cache.add(graph_id, metric)
+        raise EmptyData
+    rearranged_values = {}
+    for datum in data:
+        name = datum['name']
+        period = datum['period']
+        rearranged_values[period] = datum['values']
+    return Metric(name, rearranged_values)
+
+
+def _get_error(graph_api_error):
+    """Get the value of key "error" of the response that caused the error."""
+    result = graph_api_error.result
+    if isinstance(result, dict) and isinstance(result.get('error'), dict):
+        return result['error']
+    return {}
+
+
 class Metric(object):
     """A Facebook Insights metric.
 
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+import facebook_insights.history
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+        ('facebook_insights', '0001_initial'),
+    ]
+
+    operations = [
+        facebook_insights.history.CreatePartitionedModel(
+            name='MetricValue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.CharField(max_length=255)),
+                ('metric', models.CharField(max_length=100)),
+                ('period', models.CharField(max_length=20)),
+                ('resolution', models.CharField(choices=[('day', 'Day'), ('week', 'Week'), ('month', 'Month')], default='day', max_length=5)),
+                ('end_time', models.DateTimeField()),
+                ('value', models.BigIntegerField(blank=True, null=True)),
+                ('data', models.TextField(blank=True)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+            partition_key='end_time',
+        ),
+        migrations.AlterIndexTogether(
+            name='metricvalue',
+            index_together=set([('content_type', 'object_id', 'metric', 'end_time'), ('resolution', 'end_time')]),
+        ),
+    ]
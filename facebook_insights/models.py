@@ -1,12 +1,172 @@
-import json
 import re
 
-from django.db import models
+from django.contrib.contenttypes.models import ContentType
+from django.db import models, router, transaction
+from django.utils import six, timezone
 from django.utils.encoding import python_2_unicode_compatible
 
-from facebook_insights.metrics import fetch_metrics
+from facebook_insights.derived import set_metrics_bulk
+from facebook_insights.history import DAY, MONTH, WEEK, record_metrics
+from facebook_insights.json_codec import codec
+from facebook_insights.metrics import (Metric, explain_fetch, fetch_metrics,
+                                       fetch_metrics_bulk)
+from facebook_insights.profiling import phase, profile_if_enabled
+from facebook_insights.scheduling import (DEFAULT_FETCH_INTERVALS,
+                                          DEFAULT_TIER, get_activity,
+                                          get_fetch_interval)
 
-__all__ = ['Insights']
+__all__ = ['Insights', 'InsightsQuerySet', 'FetchSchedule', 'MetricValue',
+           'SyncRun', 'SyncBatch']
+
+
+class InsightsQuerySet(models.QuerySet):
+    """A queryset of Insights objects able to fetch their metrics in bulk."""
+
+    def _with_related_objects(self):
+        # Graph IDs are read on instantiation, so related objects storing
+        # them should be fetched by the same query.
+        related_object_field = self.model.RELATED_OBJECT_FIELD
+        if related_object_field:
+            return self.select_related(related_object_field)
+        return self
+
+    def fetch(self, metrics=None):
+        """Fetch metrics for all objects in the queryset.
+
+        The fetched values are put into corresponding fields, but the
+        objects are not saved.
+
+        Parameters
+        ----------
+        metrics : iterable of str
+            Same as for Insights.fetch().
+
+        Returns
+        -------
+        list
+            The objects of the queryset.
+
+        """
+        with phase('load'):
+            instances = list(self._with_related_objects())
+        fetch_insights(instances, metrics)
+        return instances
+
+    def explain_fetch(self, metrics=None):
+        """Plan the requests fetch() would make without making them.
+
+        Only graph IDs are read from the database, and nothing is requested
+        from Facebook. To explain a scheduled fetch, call the method on the
+        result of due() passing the metrics of the tier.
+
+        Parameters
+        ----------
+        metrics : iterable of str
+            Same as for fetch().
+
+        Returns
+        -------
+        FetchPlan
+
+        """
+        graph_ids = self.values_list(self.model.get_graph_id_lookup(),
+                                     flat=True)
+        return explain_fetch(graph_ids, metrics or self.model.METRICS,
+                             self.model.PERIODS)
+
+    def due(self, tier=DEFAULT_TIER, now=None, limit=None):
+        """Get objects which are due to be fetched (see FetchSchedule).
+
+        Parameters
+        ----------
+        tier : str
+            The name of a tier (see Insights.FETCH_TIERS).
+        now : datetime.datetime
+            Defaults to the current time.
+        limit : int
+            The maximum number of objects to return. The objects waiting
+            the longest come first.
+
+        Returns
+        -------
+        InsightsQuerySet
+
+        """
+        object_ids = FetchSchedule.objects.get_due_ids(
+            self.model, tier, now, limit,
+        )
+        return self.filter(pk__in=object_ids)
+
+    def schedule(self, tier=None, now=None):
+        """Register objects of the queryset in the fetch schedule.
+
+        Objects that are already registered are left untouched, the rest
+        become due immediately.
+
+        Parameters
+        ----------
+        tier : str
+            The name of a tier. If None, objects are registered in all of
+            the model's tiers.
+        now : datetime.datetime
+            Defaults to the current time.
+
+        """
+        tiers = [tier] if tier else list(self.model.get_fetch_tiers())
+        object_ids = self.values_list('pk', flat=True)
+        for tier in tiers:
+            FetchSchedule.objects.register(self.model, object_ids, tier, now)
+
+    def fetch_due(self, tier=DEFAULT_TIER, now=None, limit=None):
+        """Fetch metrics of the tier for objects which are due, save them
+        and schedule their next fetch.
+
+        Arguments are the same as for due().
+
+        Returns
+        -------
+        list
+            The fetched objects.
+
+        """
+        now = now or timezone.now()
+        with profile_if_enabled('fetch_due'):
+            with phase('load'):
+                instances = list(
+                    self.due(tier, now, limit)._with_related_objects()
+                )
+            if not instances:
+                return instances
+            old_values = dict((instance.pk, instance.get_tier_values(tier))
+                              for instance in instances)
+            metrics = self.model.get_fetch_tiers()[tier]
+            fetch_insights(instances, metrics)
+            using = router.db_for_write(self.model)
+            with phase('save'), transaction.atomic(using=using):
+                for instance in instances:
+                    instance.save()
+                FetchSchedule.objects.reschedule(instances, tier, old_values,
+                                                 now)
+        return instances
+
+
+def fetch_insights(instances, metrics=None):
+    """Fetch metrics for several instances of the same Insights model.
+
+    Requests for all the instances are made using fetch_metrics_bulk().
+    Metrics that failed to be fetched leave their fields untouched.
+    """
+    if not instances:
+        return
+    metrics_to_fetch = metrics or instances[0].METRICS
+    graph_ids = [instance._graph_id for instance in instances]
+    fetched_metrics = fetch_metrics_bulk(graph_ids, metrics_to_fetch,
+                                         instances[0].PERIODS)
+    with phase('map'):
+        set_metrics_bulk(instances, [
+            fetched_metrics.get(instance._graph_id, {})
+            for instance in instances
+        ])
 
 
 @python_2_unicode_compatible
@@ -14,6 +174,12 @@ class Insights(models.Model):
     """The base class for all models storing Facebook Insights metrics."""
     METRICS = None
     """iterable: A list of metrics you're interested in."""
+    PERIODS = None
+    """dict: Mappings of metric names to periods ('day', 'week', 'days_28',
+    'lifetime') to fetch the metrics for. Metrics that are not listed are
+    fetched for all available periods. Requesting only the periods you
+    store makes responses considerably smaller.
+    """
     GRAPH_ID_FIELD = 'graph_id'
     """str: The name of the field that stores the Facebook ID of the
     object for which you're retrieving metrics.
@@ -23,6 +189,32 @@ class Insights(models.Model):
     related object, then this attribute should be set to the name of
     the field referencing the related object.
     """
+    CREATED_TIME_FIELD = None
+    """str: The name of the field that stores the time when the object was
+    created on Facebook. Like GRAPH_ID_FIELD, it's looked up on the related
+    object, if RELATED_OBJECT_FIELD is set. Used to compute the object's
+    age for the fetch schedule. If None, the age is counted from the moment
+    the object was registered in the schedule.
+    """
+    FETCH_TIERS = None
+    """dict: Mappings of tier names to lists of metrics refreshed on separate
+    schedules, e.g. {'realtime': [...], 'daily': [...]}. If None, all the
+    METRICS make up a single tier named 'default'.
+    """
+    FETCH_INTERVALS = DEFAULT_FETCH_INTERVALS
+    """list or dict: Pairs of the maximum age of an object and the interval
+    between fetches for younger objects (see module 'scheduling'). A
+    dictionary maps tier names to such lists.
+    """
+    DERIVED_METRICS = None
+    """dict: Mappings of field names to expressions computing their values
+    from fetched metrics and previous values of fields (see module
+    'derived').
+    """
+    KEEP_HISTORY = False
+    """bool: If True, all fetched values are recorded into model
+    'MetricValue' when the instance is saved (see module 'history').
+    """
     REMOVE_PREFIX = True
     """
     All metrics are prepended with the name of the object they correspond to
@@ -31,6 +223,8 @@ class Insights(models.Model):
     of the field that should store a metric.
     """
 
+    objects = InsightsQuerySet.as_manager()
+
     class Meta:
         abstract = True
 
@@ -42,6 +236,7 @@ class Insights(models.Model):
         except AttributeError:  # Django 1.7
             all_field_names = self._meta.get_all_field_names()
         self._all_field_names = all_field_names
+        self._unrecorded_metrics = {}
 
     def __str__(self):
         return '<{class_name}: {pk}>'.format(
@@ -49,6 +244,12 @@ class Insights(models.Model):
             pk=self._graph_id,
         )
 
+    def save(self, *args, **kwargs):
+        super(Insights, self).save(*args, **kwargs)
+        if self._unrecorded_metrics:
+            record_metrics(self, self._unrecorded_metrics)
+            self._unrecorded_metrics = {}
+
     def __repr__(self):
         return '<{class_name}: {pk}>'.format(
             class_name=self.__class__.__name__,
@@ -69,8 +270,35 @@ class Insights(models.Model):
 
         """
         metrics_to_fetch = metrics or self.METRICS
-        fetched_metrics = fetch_metrics(self._graph_id, metrics_to_fetch)
-        for metric in fetched_metrics.values():
+        fetched_metrics = fetch_metrics(self._graph_id, metrics_to_fetch,
+                                        self.PERIODS)
+        with phase('map'):
+            set_metrics_bulk([self], [fetched_metrics])
+
+    def explain_fetch(self, metrics=None):
+        """Plan the requests fetch() would make without making them.
+
+        Returns
+        -------
+        FetchPlan
+
+        """
+        return explain_fetch([self._graph_id], metrics or self.METRICS,
+                             self.PERIODS)
+
+    def set_metrics(self, metrics):
+        """Put fetched metrics into corresponding fields.
+
+        Parameters
+        ----------
+        metrics : dict
+            A mapping of metric names to instances of class 'Metric'
+            (as returned by fetch_metrics()).
+
+        """
+        if self.KEEP_HISTORY:
+            self._unrecorded_metrics.update(metrics)
+        for metric in metrics.values():
             field_name = self.get_field_name(metric)
             field_value = self.get_field_value(metric)
             if field_name not in self._all_field_names:
@@ -95,10 +323,44 @@ class Insights(models.Model):
             field_value = metric.get_value(extract=True)
         else:
             field_value = metric.get_all_values(extract=True)
-        # Values that are not numbers are serialized into JSON
-        if not isinstance(field_value, int):
-            field_value = json.dumps(field_value)
-        return field_value
+        # Values that are not numbers are serialized into JSON, unless the
+        # field is able to store them as they are.
+        if isinstance(field_value, int):
+            return field_value
+        if self.get_field_name(metric) in self.get_json_field_names():
+            return field_value
+        return codec.dumps(field_value)
+
+    @classmethod
+    def get_derived_field_names(cls):
+        """Get names of the fields storing derived metrics."""
+        return sorted(cls.DERIVED_METRICS or {})
+
+    @classmethod
+    def get_json_field_names(cls):
+        """Get names of the model's fields storing JSON natively (e.g.
+        django.contrib.postgres.fields.JSONField).
+        """
+        # The result is cached on the class, so the fields are inspected
+        # only once per model.
+        if '_json_field_names' not in cls.__dict__:
+            cls._json_field_names = frozenset(
+                field.name for field in cls._meta.concrete_fields
+                if field.get_internal_type() == 'JSONField'
+            )
+        return cls._json_field_names
+
+    def get_decoded_value(self, field_name):
+        """Get the value of a field storing a metric as a Python object.
+
+        Values of JSON fields are returned as they are, JSON strings stored
+        in other fields are decoded.
+        """
+        value = getattr(self, field_name)
+        if (isinstance(value, six.string_types) and
+                field_name not in self.get_json_field_names()):
+            return codec.loads(value)
+        return value
 
     def get_graph_id(self):
         """Get graph ID of the object for which metrics are to be collected."""
@@ -106,3 +368,260 @@ class Insights(models.Model):
             related_object = getattr(self, self.RELATED_OBJECT_FIELD)
             return getattr(related_object, self.GRAPH_ID_FIELD)
         return getattr(self, self.GRAPH_ID_FIELD)
+
+    @classmethod
+    def get_graph_id_lookup(cls):
+        """Get the lookup to query graph IDs of objects with, e.g. with
+        values_list().
+        """
+        if cls.RELATED_OBJECT_FIELD:
+            return '{}__{}'.format(cls.RELATED_OBJECT_FIELD,
+                                   cls.GRAPH_ID_FIELD)
+        return cls.GRAPH_ID_FIELD
+
+    def get_created_time(self):
+        """Get the time when the object was created on Facebook or None,
+        if CREATED_TIME_FIELD is not set.
+        """
+        if not self.CREATED_TIME_FIELD:
+            return None
+        if self.RELATED_OBJECT_FIELD:
+            related_object = getattr(self, self.RELATED_OBJECT_FIELD)
+            return getattr(related_object, self.CREATED_TIME_FIELD)
+        return getattr(self, self.CREATED_TIME_FIELD)
+
+    @classmethod
+    def get_fetch_tiers(cls):
+        """Get a mapping of tier names to lists of metrics."""
+        if cls.FETCH_TIERS:
+            return cls.FETCH_TIERS
+        return {DEFAULT_TIER: cls.METRICS}
+
+    @classmethod
+    def get_fetch_intervals(cls, tier):
+        """Get pairs of maximum ages and fetch intervals for the tier."""
+        if isinstance(cls.FETCH_INTERVALS, dict):
+            return cls.FETCH_INTERVALS.get(tier, DEFAULT_FETCH_INTERVALS)
+        return cls.FETCH_INTERVALS
+
+    def get_tier_values(self, tier):
+        """Get a mapping of field names to current values of the tier's
+        metrics. Used to measure the object's activity.
+        """
+        values = {}
+        for metric_name in self.get_fetch_tiers()[tier]:
+            field_name = self.get_field_name(Metric(metric_name, {}))
+            values[field_name] = getattr(self, field_name, None)
+        return values
+
+
+class FetchScheduleManager(models.Manager):
+
+    def get_due_ids(self, model, tier=DEFAULT_TIER, now=None, limit=None):
+        """Get primary keys of the model's objects which are due."""
+        now = now or timezone.now()
+        schedules = self.filter(
+            content_type=ContentType.objects.get_for_model(model),
+            tier=tier,
+            next_fetch_at__lte=now,
+        ).order_by('next_fetch_at')
+        object_ids = schedules.values_list('object_id', flat=True)
+        if limit is not None:
+            object_ids = object_ids[:limit]
+        return list(object_ids)
+
+    def register(self, model, object_ids, tier=DEFAULT_TIER, now=None):
+        """Create schedules for objects that don't have them yet."""
+        now = now or timezone.now()
+        content_type = ContentType.objects.get_for_model(model)
+        object_ids = set(str(object_id) for object_id in object_ids)
+        # Schedules are looked up where they're created, since a replica
+        # may lag behind.
+        using = router.db_for_write(self.model)
+        registered_ids = set(self.using(using).filter(
+            content_type=content_type,
+            tier=tier,
+            object_id__in=object_ids,
+        ).values_list('object_id', flat=True))
+        self.using(using).bulk_create([
+            self.model(
+                content_type=content_type,
+                object_id=object_id,
+                tier=tier,
+                next_fetch_at=now,
+            )
+            for object_id in object_ids - registered_ids
+        ])
+
+    def reschedule(self, instances, tier, old_values, now=None):
+        """Compute the next fetch time for objects that have just been
+        fetched.
+
+        Parameters
+        ----------
+        instances : list of Insights
+            Instances of the same model.
+        tier : str
+            The tier whose metrics were fetched.
+        old_values : dict
+            A mapping of primary keys to values returned by
+            Insights.get_tier_values() before the fetch.
+        now : datetime.datetime
+            The time of the fetch, defaults to the current time.
+
+        """
+        if not instances:
+            return
+        now = now or timezone.now()
+        model = type(instances[0])
+        intervals = model.get_fetch_intervals(tier)
+        self.register(model, [instance.pk for instance in instances], tier,
+                      now)
+        using = router.db_for_write(self.model)
+        schedules = dict(
+            (schedule.object_id, schedule)
+            for schedule in self.using(using).filter(
+                content_type=ContentType.objects.get_for_model(model),
+                tier=tier,
+                object_id__in=[str(instance.pk) for instance in instances],
+            )
+        )
+        for instance in instances:
+            schedule = schedules[str(instance.pk)]
+            created_time = instance.get_created_time() or schedule.created_at
+            activity = None
+            if schedule.last_fetched_at:
+                activity = get_activity(old_values.get(instance.pk),
+                                        instance.get_tier_values(tier))
+            interval = get_fetch_interval(now - created_time, activity,
+                                          intervals)
+            schedule.last_fetched_at = now
+            schedule.next_fetch_at = now + interval
+            schedule.save(update_fields=['last_fetched_at', 'next_fetch_at'])
+
+
+@python_2_unicode_compatible
+class FetchSchedule(models.Model):
+    """The time when metrics of a tier should be fetched for an object."""
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.CharField(max_length=255)
+    tier = models.CharField(max_length=50, default=DEFAULT_TIER)
+    next_fetch_at = models.DateTimeField()
+    last_fetched_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    objects = FetchScheduleManager()
+
+    class Meta:
+        unique_together = [('content_type', 'object_id', 'tier')]
+        index_together = [('content_type', 'tier', 'next_fetch_at')]
+
+    def __str__(self):
+        return '{}.{} [{}]: {}'.format(
+            self.content_type_id,
+            self.object_id,
+            self.tier,
+            self.next_fetch_at,
+        )
+
+
+@python_2_unicode_compatible
+class MetricValue(models.Model):
+    """A value of a metric for a given moment (see module 'history')."""
+    RESOLUTION_CHOICES = [
+        (DAY, 'Day'),
+        (WEEK, 'Week'),
+        (MONTH, 'Month'),
+    ]
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.CharField(max_length=255)
+    metric = models.CharField(max_length=100)
+    period = models.CharField(max_length=20)
+    resolution = models.CharField(max_length=5, choices=RESOLUTION_CHOICES,
+                                  default=DAY)
+    end_time = models.DateTimeField()
+    value = models.BigIntegerField(null=True, blank=True)
+    data = models.TextField(blank=True)
+    """JSON representation of values that are not numbers."""
+
+    class Meta:
+        index_together = [
+            ('content_type', 'object_id', 'metric', 'end_time'),
+            ('resolution', 'end_time'),
+        ]
+
+    def __str__(self):
+        return '{} {} [{}]: {}'.format(
+            self.metric,
+            self.period,
+            self.end_time,
+            self.value if self.value is not None else self.data,
+        )
+
+    def get_value(self):
+        """Get the value as a Python object."""
+        if self.value is not None:
+            return self.value
+        return codec.loads(self.data) if self.data else None
+
+
+@python_2_unicode_compatible
+class SyncRun(models.Model):
+    """A run of FetchPipeline over the objects of a model.
+
+    The run remembers which objects have been saved, so that an interrupted
+    run can be resumed without fetching them again (see module 'pipeline').
+    """
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (RUNNING, 'Running'),
+        (COMPLETED, 'Completed'),
+        (FAILED, 'Failed'),
+    ]
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    metrics = models.TextField(blank=True)
+    """JSON list of the fetched metrics."""
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=RUNNING)
+    cursor = models.CharField(max_length=255, blank=True)
+    """The primary key of the last object such that all objects up to it
+    (in order of primary keys) have been saved.
+    """
+    objects_done = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return '{} [{}]: {} objects'.format(
+            self.pk,
+            self.status,
+            self.objects_done,
+        )
+
+
+@python_2_unicode_compatible
+class SyncBatch(models.Model):
+    """A chunk of objects saved during a SyncRun.
+
+    Chunks are ranges of primary keys, bounds included.
+    """
+    run = models.ForeignKey(SyncRun, on_delete=models.CASCADE,
+                            related_name='batches')
+    number = models.PositiveIntegerField()
+    first_pk = models.CharField(max_length=255)
+    last_pk = models.CharField(max_length=255)
+    size = models.PositiveIntegerField()
+    completed_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = [('run', 'number')]
+
+    def __str__(self):
+        return '{} #{}: {}..{}'.format(
+            self.run_id,
+            self.number,
+            self.first_pk,
+            self.last_pk,
+        )
@@ -0,0 +1,188 @@
+"""A negative cache for metrics that Facebook can't provide.
+
+Some objects fail the same way on every run: a page with less than 30 likes
+always returns empty data, an object your app has no permissions for always
+returns a permission error, and so on. The negative cache remembers such
+(graph_id, metric) pairs, so the request planner in fetch_metrics() can skip
+them until they expire. Every subsequent failure of the same pair doubles its
+expiry time (up to a configurable maximum). The number of failures is kept
+for another `max_timeout` seconds after a pair expires, so a pair failing
+again once it's requested is skipped for longer.
+
+The cache is stored using Django's cache framework and is disabled by default.
+To enable it, set FACEBOOK_INSIGHTS_NEGATIVE_CACHE to the alias of one of
+the caches defined in the CACHES setting:
+
+    FACEBOOK_INSIGHTS_NEGATIVE_CACHE = 'default'
+    # The expiry time after the first failure (in seconds)
+    FACEBOOK_INSIGHTS_NEGATIVE_CACHE_TIMEOUT = 60 * 60 * 24
+    # The upper bound for the expiry time (in seconds)
+    FACEBOOK_INSIGHTS_NEGATIVE_CACHE_MAX_TIMEOUT = 60 * 60 * 24 * 30
+
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+__all__ = ['NegativeCache', 'negative_cache', 'is_permanent_error']
+
+# Codes of errors which are caused by the object itself rather than by the
+# state of Facebook's servers or of the access token: 100 - invalid parameter
+# (e.g. the object doesn't exist or doesn't support the metric), 10 and
+# 200-299 - the app doesn't have permissions to access the object's insights.
+PERMANENT_ERROR_CODES = frozenset([10, 100] + list(range(200, 300)))
+
+
+def is_permanent_error(error):
+    """Check whether an error from Graph API is going to repeat on every
+    request for the same object.
+
+    Parameters
+    ----------
+    error : dict
+        The value of key "error" of a Graph API response.
+
+    """
+    if error.get('is_transient'):
+        return False
+    return error.get('code') in PERMANENT_ERROR_CODES
+
+
+class NegativeCache(object):
+    """A cache of (graph_id, metric) pairs that shouldn't be requested.
+
+    Parameters
+    ----------
+    cache_alias : str or None
+        The alias of a Django cache used to store the pairs. If None, the
+        negative cache is disabled: nothing is stored and nothing is skipped.
+    timeout : int
+        The number of seconds a pair is skipped for after its first failure.
+    max_timeout : int
+        The maximum number of seconds a pair can be skipped for.
+
+    """
+    key_prefix = 'facebook_insights:negative'
+
+    def __init__(self, cache_alias=None, timeout=60 * 60 * 24,
+                 max_timeout=60 * 60 * 24 * 30):
+        self.cache_alias = cache_alias
+        self.timeout = timeout
+        self.max_timeout = max_timeout
+
+    @property
+    def enabled(self):
+        return self.cache_alias is not None
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def make_key(self, graph_id, metric):
+        return '{}:{}:{}'.format(self.key_prefix, graph_id, metric)
+
+    def get_cached(self, graph_id, metrics):
+        """Get those of the object's metrics that are in the cache.
+
+        Returns
+        -------
+        set of str
+
+        """
+        return set(metric for _, metric
+                   in self.get_cached_pairs([(graph_id, metrics)]))
+
+    def get_cached_pairs(self, metrics_by_id):
+        """Get the cached pairs for several objects with a single query.
+
+        Parameters
+        ----------
+        metrics_by_id : iterable of tuple
+            Pairs of graph IDs and lists of metrics.
+
+        Returns
+        -------
+        set of tuple
+            The (graph_id, metric) pairs that are in the cache.
+
+        """
+        if not self.enabled:
+            return set()
+        keys = {}
+        for graph_id, metrics in metrics_by_id:
+            for metric in metrics:
+                keys[self.make_key(graph_id, metric)] = (graph_id, metric)
+        now = time.time()
+        return set(keys[key] for key, (_, skip_until)
+                   in self.cache.get_many(list(keys)).items()
+                   if skip_until > now)
+
+    def filter(self, graph_id, metrics):
+        """Remove the cached metrics from a list of the object's metrics.
+
+        Returns
+        -------
+        list of str
+            The metrics that are not in the cache, in their original order.
+
+        """
+        cached = self.get_cached(graph_id, metrics)
+        return [metric for metric in metrics if metric not in cached]
+
+    def filter_many(self, metrics_by_id):
+        """Remove the cached metrics from lists of metrics of several objects.
+
+        Parameters
+        ----------
+        metrics_by_id : list of tuple
+            Pairs of graph IDs and lists of metrics.
+
+        Returns
+        -------
+        list of tuple
+            Pairs of graph IDs and lists of metrics that are not in the
+            cache. Objects left without metrics are excluded.
+
+        """
+        cached = self.get_cached_pairs(metrics_by_id)
+        filtered = []
+        for graph_id, metrics in metrics_by_id:
+            metrics = [metric for metric in metrics
+                       if (graph_id, metric) not in cached]
+            if metrics:
+                filtered.append((graph_id, metrics))
+        return filtered
+
+    def add(self, graph_id, metric):
+        """Put a pair into the cache or prolong its expiry time, if the pair
+        is already there.
+        """
+        if not self.enabled:
+            return
+        key = self.make_key(graph_id, metric)
+        failures, _ = self.cache.get(key) or (0, None)
+        failures += 1
+        timeout = min(self.timeout * 2 ** (failures - 1), self.max_timeout)
+        # The entry outlives the skip, so that the next failure of the pair
+        # knows about the previous ones.
+        self.cache.set(key, (failures, time.time() + timeout),
+                       timeout + self.max_timeout)
+
+    def remove(self, graph_id, metric):
+        """Remove a pair from the cache, so it's requested on the next run."""
+        if not self.enabled:
+            return
+        self.cache.delete(self.make_key(graph_id, metric))
+
+
+negative_cache = NegativeCache(
+    cache_alias=getattr(settings, 'FACEBOOK_INSIGHTS_NEGATIVE_CACHE', None),
+    timeout=getattr(
+        settings, 'FACEBOOK_INSIGHTS_NEGATIVE_CACHE_TIMEOUT', 60 * 60 * 24
+    ),
+    max_timeout=getattr(
+        settings, 'FACEBOOK_INSIGHTS_NEGATIVE_CACHE_MAX_TIMEOUT',
+        60 * 60 * 24 * 30
+    ),
+)
@@ -0,0 +1,344 @@
+"""A memory-bounded pipeline to fetch and save metrics of large querysets.
+
+>>> pipeline = FetchPipeline(PostInsights.objects.all(), chunk_size=500)
+>>> pipeline.run()
+{'chunks': 2000, 'objects': 1000000}
+
+Objects are read from the database in chunks using keyset pagination over
+the primary key, so memory usage doesn't depend on the size of the table.
+Chunks are fetched from Facebook by background threads and saved by the
+thread that runs the pipeline: while one chunk is being written to the
+database, the following ones are on the wire. At most `max_pending_chunks`
+chunks are read but not saved at any moment. When the limit is reached,
+reading pauses until the oldest chunk is saved.
+
+Database queries are made by the thread calling run(), so the pipeline can
+be run inside a transaction. This includes lookups of access tokens: they are
+loaded before a chunk is handed to a worker (see BaseTokenProvider.prefetch()).
+Connections opened by workers anyway (e.g. by a custom token provider without
+prefetch()) are closed when the workers exit.
+
+Every run is tracked with a SyncRun object recording saved chunks, so a run
+interrupted by a crash or a deploy can be resumed without spending the quota
+on objects that are already saved:
+
+>>> pipeline = FetchPipeline(PostInsights.objects.all())
+>>> pipeline.run()  # Interrupted
+>>> pipeline.sync_run.pk
+42
+>>> FetchPipeline(PostInsights.objects.all(), resume=42).run()
+
+Progress is saved once per `checkpoint_interval` chunks, so after a hard
+crash at most that many saved chunks are fetched again.
+
+"""
+import logging
+import threading
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, router, transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.six.moves import queue
+
+from facebook_insights.json_codec import codec
+from facebook_insights.metrics import Metric, prefetch_tokens
+from facebook_insights.models import SyncBatch, SyncRun, fetch_insights
+from facebook_insights.profiling import phase, profile_if_enabled
+
+__all__ = ['FetchPipeline']
+
+logger = logging.getLogger(__name__)
+
+
+class FetchPipeline(object):
+    """Fetch metrics for all objects of a queryset and save them.
+
+    Parameters
+    ----------
+    queryset : InsightsQuerySet
+        The objects to process.
+    metrics : iterable of str
+        Metrics to fetch. Defaults to the model's METRICS.
+    chunk_size : int
+        The number of objects read, fetched and saved at once.
+    max_pending_chunks : int
+        The maximum number of chunks that are read but not yet saved.
+    fetch_workers : int
+        The number of threads making requests to Facebook.
+    resume : int
+        The ID of a SyncRun to resume. Objects saved during the run are
+        skipped. The queryset should be the same as the one the run was
+        started with.
+    checkpoint_interval : int
+        The number of saved chunks after which the progress of the run is
+        saved.
+
+    Attributes
+    ----------
+    sync_run : SyncRun
+        The run being tracked. Available once run() is called.
+
+    """
+
+    def __init__(self, queryset, metrics=None, chunk_size=500,
+                 max_pending_chunks=2, fetch_workers=1, resume=None,
+                 checkpoint_interval=10):
+        self.queryset = queryset
+        self.metrics = metrics or queryset.model.METRICS
+        self.chunk_size = chunk_size
+        self.max_pending_chunks = max(max_pending_chunks, fetch_workers)
+        self.fetch_workers = fetch_workers
+        self.resume = resume
+        self.checkpoint_interval = checkpoint_interval
+        self.sync_run = None
+
+    def start_run(self):
+        """Create a SyncRun or load the one to resume."""
+        content_type = ContentType.objects.get_for_model(self.queryset.model)
+        if self.resume is None:
+            return SyncRun.objects.create(
+                content_type=content_type,
+                metrics=codec.dumps(list(self.metrics)),
+            )
+        # Progress is read where it's written, since a replica may lag
+        # behind.
+        sync_run = SyncRun.objects.using(self.get_tracking_database()).get(
+            pk=self.resume,
+        )
+        if sync_run.content_type_id != content_type.pk:
+            raise ValueError(
+                "Run {} was started for another model.".format(sync_run.pk)
+            )
+        sync_run.status = SyncRun.RUNNING
+        sync_run.finished_at = None
+        sync_run.save(update_fields=['status', 'finished_at'])
+        return sync_run
+
+    def get_tracking_database(self):
+        return router.db_for_write(SyncRun)
+
+    def get_batches(self):
+        """Get saved chunks of the run."""
+        return SyncBatch.objects.using(self.get_tracking_database()).filter(
+            run=self.sync_run,
+        )
+
+    def get_progress(self):
+        """Get the cursor of the run and ranges of primary keys saved after
+        it.
+
+        Returns
+        -------
+        tuple
+            The cursor (or None) and a list of pairs of primary keys.
+
+        """
+        if self.sync_run is None:
+            return None, []
+        to_python = self.queryset.model._meta.pk.to_python
+        cursor = None
+        if self.sync_run.cursor:
+            cursor = to_python(self.sync_run.cursor)
+        saved_ranges = []
+        batches = self.get_batches().values_list('first_pk', 'last_pk')
+        for first_pk, last_pk in batches:
+            first_pk, last_pk = to_python(first_pk), to_python(last_pk)
+            if cursor is None or first_pk > cursor:
+                saved_ranges.append((first_pk, last_pk))
+        return cursor, saved_ranges
+
+    def iter_chunks(self):
+        """Yield lists of objects ordered by the primary key.
+
+        Objects already saved during the tracked run are skipped.
+        """
+        queryset = self.queryset._with_related_objects().order_by('pk')
+        last_pk, saved_ranges = self.get_progress()
+        for first_pk, end_pk in saved_ranges:
+            queryset = queryset.exclude(pk__range=(first_pk, end_pk))
+        while True:
+            chunk_queryset = queryset
+            if last_pk is not None:
+                chunk_queryset = queryset.filter(pk__gt=last_pk)
+            with phase('load'):
+                chunk = list(chunk_queryset[:self.chunk_size])
+            if not chunk:
+                return
+            yield chunk
+            last_pk = chunk[-1].pk
+
+    def prefetch(self, chunk):
+        """Load what's needed to fetch a chunk of objects without querying
+        the database.
+
+        Returns
+        -------
+        context manager
+            The fetch of the chunk is made within it.
+
+        """
+        return prefetch_tokens([instance._graph_id for instance in chunk])
+
+    def fetch(self, chunk):
+        """Fetch metrics for a chunk of objects (runs in a worker thread)."""
+        fetch_insights(chunk, self.metrics)
+
+    def write(self, chunk):
+        """Save fetched metrics of a chunk of objects."""
+        update_fields = [chunk[0].get_field_name(Metric(metric, {}))
+                         for metric in self.metrics]
+        update_fields.extend(chunk[0].get_derived_field_names())
+        using = router.db_for_write(self.queryset.model)
+        with phase('save'), transaction.atomic(using=using):
+            for instance in chunk:
+                instance.save(update_fields=update_fields)
+
+    def checkpoint(self, batches, cursor):
+        """Save the progress of the run.
+
+        Parameters
+        ----------
+        batches : list of SyncBatch
+            Chunks saved since the previous checkpoint.
+        cursor : object
+            The primary key up to which all objects are saved, or None, if
+            it hasn't moved.
+
+        """
+        if not batches:
+            return
+        SyncBatch.objects.bulk_create(batches)
+        if cursor is not None:
+            self.sync_run.cursor = str(cursor)
+        self.sync_run.objects_done += sum(batch.size for batch in batches)
+        self.sync_run.save(update_fields=['cursor', 'objects_done'])
+
+    def finish_run(self, status):
+        self.sync_run.status = status
+        self.sync_run.finished_at = timezone.now()
+        self.sync_run.save(update_fields=['status', 'finished_at'])
+
+    def _work(self, fetch_queue, done_queue):
+        try:
+            while True:
+                item = fetch_queue.get()
+                if item is None:
+                    return
+                number, chunk, prefetched = item
+                try:
+                    with prefetched:
+                        self.fetch(chunk)
+                except Exception as error:
+                    done_queue.put((number, chunk, error))
+                else:
+                    done_queue.put((number, chunk, None))
+        finally:
+            connections.close_all()
+
+    def run(self):
+        """Run the pipeline until all objects are processed.
+
+        Returns
+        -------
+        dict
+            The number of processed chunks and objects.
+
+        Raises
+        ------
+        Exception
+            The first error raised by the fetch stage. Chunks that were
+            fetched before the error are saved, and the run is marked as
+            failed.
+
+        """
+        with profile_if_enabled('pipeline'):
+            return self._run()
+
+    def _run(self):
+        self.sync_run = self.start_run()
+        last_number = self.get_batches().aggregate(
+            last_number=Max('number'),
+        )['last_number']
+        first_number = 0 if last_number is None else last_number + 1
+        fetch_queue = queue.Queue()
+        done_queue = queue.Queue()
+        workers = [
+            threading.Thread(target=self._work,
+                             args=(fetch_queue, done_queue))
+            for _ in range(self.fetch_workers)
+        ]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        stats = {'chunks': 0, 'objects': 0}
+        chunks = self.iter_chunks()
+        read = 0
+        pending = 0
+        exhausted = False
+        # Chunks may be fetched out of order. The cursor moves only past
+        # chunks whose predecessors are all saved.
+        last_pks = {}
+        next_number = 0
+        batches = []
+        cursor = None
+        status = SyncRun.FAILED
+        try:
+            while True:
+                # Read new chunks only while there is room for them, so that
+                # memory usage stays bounded when saving falls behind.
+                while not exhausted and pending < self.max_pending_chunks:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        exhausted = True
+                    else:
+                        fetch_queue.put((read, chunk, self.prefetch(chunk)))
+                        read += 1
+                        pending += 1
+                if not pending:
+                    break
+                number, chunk, error = done_queue.get()
+                pending -= 1
+                if error is not None:
+                    raise error
+                self.write(chunk)
+                stats['chunks'] += 1
+                stats['objects'] += len(chunk)
+                batches.append(SyncBatch(
+                    run=self.sync_run,
+                    number=first_number + number,
+                    first_pk=str(chunk[0].pk),
+                    last_pk=str(chunk[-1].pk),
+                    size=len(chunk),
+                ))
+                last_pks[number] = chunk[-1].pk
+                while next_number in last_pks:
+                    cursor = last_pks.pop(next_number)
+                    next_number += 1
+                if len(batches) >= self.checkpoint_interval:
+                    self.checkpoint(batches, cursor)
+                    batches = []
+                    cursor = None
+            status = SyncRun.COMPLETED
+        finally:
+            # Drop chunks that are not fetched yet, if the pipeline failed
+            while True:
+                try:
+                    fetch_queue.get_nowait()
+                except queue.Empty:
+                    break
+            for _ in workers:
+                fetch_queue.put(None)
+            if status == SyncRun.COMPLETED:
+                self.checkpoint(batches, cursor)
+                self.finish_run(status)
+            else:
+                # Don't let a failure to save the progress hide the error
+                # that stopped the run.
+                try:
+                    self.checkpoint(batches, cursor)
+                    self.finish_run(status)
+                except Exception:
+                    logger.exception("Failed to save the progress of run %s",
+                                     self.sync_run.pk)
+        return stats
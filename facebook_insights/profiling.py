@@ -0,0 +1,265 @@
+"""Opt-in profiling of fetches.
+
+A profile measures the time spent in each phase of fetching and saving
+metrics, and optionally collects cProfile statistics and tracemalloc
+snapshots. Wrap any code in profile() to profile it:
+
+>>> with profile('backfill', directory='/tmp/profiles') as prof:
+...     FetchPipeline(PostInsights.objects.all()).run()
+>>> prof.paths
+['/tmp/profiles/backfill-20161115T120000-4242.txt',
+ '/tmp/profiles/backfill-20161115T120000-4242.prof']
+
+The phases are:
+
+* 'load' - reading objects from the database (including instantiation of
+  models);
+* 'fetch' - batch requests to Graph API;
+* 'parse' - decoding responses into instances of class 'Metric';
+* 'map' - putting metrics into fields (get_field_name(), get_field_value());
+* 'save' - writing objects to the database.
+
+To profile production runs without changing any code, set
+FACEBOOK_INSIGHTS_PROFILING. A share of runs of FetchPipeline and
+fetch_due() is then profiled:
+
+    FACEBOOK_INSIGHTS_PROFILING = {
+        'directory': '/var/log/insights-profiles',
+        'sample_rate': 0.05,    # profile 5% of runs
+        'cprofile': True,
+        'tracemalloc': True,    # Python 3.4+
+        'top': 30,              # lines in cProfile and tracemalloc reports
+    }
+
+cProfile only sees the thread that entered the profile, so time spent in
+FetchPipeline's fetch workers shows up in the phase timers and tracemalloc
+statistics only.
+
+"""
+import cProfile
+import logging
+import os
+import pstats
+import random
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from timeit import default_timer
+
+from django.conf import settings
+from django.utils import six
+
+try:
+    import tracemalloc as _tracemalloc
+except ImportError:  # Python 2
+    _tracemalloc = None
+
+__all__ = ['PHASES', 'Profile', 'profile', 'profile_if_enabled', 'phase']
+
+logger = logging.getLogger(__name__)
+
+PHASES = ['load', 'fetch', 'parse', 'map', 'save']
+
+DEFAULTS = {
+    'directory': None,
+    'sample_rate': 1.0,
+    'cprofile': True,
+    'tracemalloc': True,
+    'top': 30,
+}
+
+_active_profile = None
+_active_profile_lock = threading.Lock()
+
+
+class Profile(object):
+    """A profile of a block of code.
+
+    Parameters
+    ----------
+    name : str
+        The name used as a prefix of report files.
+    directory : str
+        The directory to write reports to. If None, reports are not written.
+    cprofile : bool
+        Whether to collect cProfile statistics.
+    tracemalloc : bool
+        Whether to take tracemalloc snapshots (ignored on Python 2).
+    top : int
+        The number of entries in cProfile and tracemalloc reports.
+
+    Attributes
+    ----------
+    timers : dict
+        Mappings of phase names to pairs of the number of calls and the
+        total time in seconds.
+    paths : list of str
+        Paths of written reports.
+
+    """
+
+    def __init__(self, name, directory=None, cprofile=True, tracemalloc=True,
+                 top=30):
+        self.name = name
+        self.directory = directory
+        self.top = top
+        self.timers = dict((phase_name, [0, 0.0]) for phase_name in PHASES)
+        self.paths = []
+        self.duration = None
+        self._profiler = cProfile.Profile() if cprofile else None
+        self._trace_memory = bool(tracemalloc and _tracemalloc)
+        self._started_tracing = False
+        self._start_snapshot = None
+        self._end_snapshot = None
+        self._started_at = None
+        self._lock = threading.Lock()
+
+    def add_time(self, phase_name, seconds):
+        with self._lock:
+            timer = self.timers.setdefault(phase_name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+
+    def start(self):
+        if self._trace_memory:
+            if not _tracemalloc.is_tracing():
+                _tracemalloc.start()
+                self._started_tracing = True
+            self._start_snapshot = _tracemalloc.take_snapshot()
+        self._started_at = default_timer()
+        if self._profiler:
+            self._profiler.enable()
+
+    def stop(self):
+        if self._profiler:
+            self._profiler.disable()
+        self.duration = default_timer() - self._started_at
+        if self._trace_memory:
+            self._end_snapshot = _tracemalloc.take_snapshot()
+            if self._started_tracing:
+                _tracemalloc.stop()
+
+    def get_report(self):
+        """Get a text report with phase timers, the top of memory
+        allocations and the top of cProfile statistics.
+        """
+        lines = ['Profile {!r}: {:.3f}s'.format(self.name, self.duration), '',
+                 '{:<10}{:>10}{:>12}{:>8}'.format('phase', 'calls', 'seconds',
+                                                   '%')]
+        for phase_name in sorted(self.timers, key=self._get_phase_order):
+            calls, seconds = self.timers[phase_name]
+            share = 100 * seconds / self.duration if self.duration else 0
+            lines.append('{:<10}{:>10}{:>12.3f}{:>8.1f}'.format(
+                phase_name, calls, seconds, share,
+            ))
+        if self._end_snapshot is not None:
+            lines.extend(['', 'Memory allocated during the profile:'])
+            differences = self._end_snapshot.compare_to(self._start_snapshot,
+                                                        'lineno')
+            lines.extend(str(difference)
+                         for difference in differences[:self.top])
+        if self._profiler:
+            stream = six.StringIO()
+            stats = pstats.Stats(self._profiler, stream=stream)
+            stats.sort_stats('cumulative').print_stats(self.top)
+            lines.extend(['', stream.getvalue()])
+        return '\n'.join(lines)
+
+    def write_reports(self):
+        """Write the text report and cProfile statistics (for pstats or
+        snakeviz) to the directory.
+        """
+        if not self.directory:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        prefix = os.path.join(self.directory, '{}-{}-{}'.format(
+            self.name,
+            datetime.now().strftime('%Y%m%dT%H%M%S'),
+            os.getpid(),
+        ))
+        with open(prefix + '.txt', 'w') as report_file:
+            report_file.write(self.get_report())
+        self.paths.append(prefix + '.txt')
+        if self._profiler:
+            self._profiler.dump_stats(prefix + '.prof')
+            self.paths.append(prefix + '.prof')
+
+    @staticmethod
+    def _get_phase_order(phase_name):
+        if phase_name in PHASES:
+            return PHASES.index(phase_name), phase_name
+        return len(PHASES), phase_name
+
+
+@contextmanager
+def profile(name='fetch', directory=None, sample_rate=1.0, **options):
+    """Profile a block of code.
+
+    Parameters
+    ----------
+    name : str
+        The name used as a prefix of report files.
+    directory : str
+        The directory to write reports to.
+    sample_rate : float
+        The probability that the block is profiled.
+    options
+        The rest of the arguments of class 'Profile'.
+
+    Yields
+    ------
+    Profile or None
+        None, if the block isn't sampled. If another profile is active, the
+        block becomes a part of it.
+
+    """
+    global _active_profile
+    with _active_profile_lock:
+        if _active_profile is not None:
+            nested = True
+            current_profile = _active_profile
+        else:
+            nested = False
+            current_profile = None
+            if random.random() < sample_rate:
+                current_profile = Profile(name, directory, **options)
+                _active_profile = current_profile
+    if nested or current_profile is None:
+        yield current_profile
+        return
+    current_profile.start()
+    try:
+        yield current_profile
+    finally:
+        current_profile.stop()
+        with _active_profile_lock:
+            _active_profile = None
+        try:
+            current_profile.write_reports()
+        except (IOError, OSError):
+            logger.exception("Failed to write the profile of '%s'", name)
+
+
+def profile_if_enabled(name):
+    """Profile a block of code, if FACEBOOK_INSIGHTS_PROFILING is set."""
+    options = getattr(settings, 'FACEBOOK_INSIGHTS_PROFILING', None)
+    if options is None:
+        return profile(name, sample_rate=0)
+    kwargs = dict(DEFAULTS)
+    kwargs.update(options)
+    return profile(name, **kwargs)
+
+
+@contextmanager
+def phase(name):
+    """Measure the time spent in a phase of the active profile, if any."""
+    current_profile = _active_profile
+    if current_profile is None:
+        yield
+        return
+    start = default_timer()
+    try:
+        yield
+    finally:
+        current_profile.add_time(name, default_timer() - start)
@@ -0,0 +1,97 @@
+"""A database router sending reads of metrics to a replica.
+
+Big syncs read lots of graph IDs (including those of related objects) and
+due objects. To keep that traffic away from the primary database, add the
+router to your settings and point it to a replica:
+
+    DATABASE_ROUTERS = ['facebook_insights.routers.InsightsRouter']
+
+    # The alias to write fetched metrics to (defaults to 'default')
+    FACEBOOK_INSIGHTS_WRITE_DATABASE = 'analytics'
+    # The alias to read Insights objects, schedules and history from
+    # (defaults to the write database)
+    FACEBOOK_INSIGHTS_READ_DATABASE = 'analytics_replica'
+
+The router handles subclasses of Insights and models of this app. Their
+tables are migrated on the write database only, so the read database must be
+a replica of the write database. Objects read from the replica are saved to
+the write database. Related objects of Insights objects (see
+RELATED_OBJECT_FIELD) are read from the same database as the objects
+themselves, so the replica should contain their tables too.
+
+Queries whose results are written back right away (e.g. looking up existing
+schedules before creating new ones, or the progress of a resumed run) are
+made against the write database to avoid replication lag.
+
+"""
+from django.apps import apps
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import six
+
+__all__ = ['InsightsRouter', 'get_read_database', 'get_write_database']
+
+APP_LABEL = 'facebook_insights'
+
+
+def get_read_database():
+    """Get the alias to read metrics from.
+
+    Defaults to the write database, since tables are only created there.
+    """
+    return (getattr(settings, 'FACEBOOK_INSIGHTS_READ_DATABASE', None) or
+            get_write_database())
+
+
+def get_write_database():
+    """Get the alias to write metrics to."""
+    return getattr(settings, 'FACEBOOK_INSIGHTS_WRITE_DATABASE',
+                   DEFAULT_DB_ALIAS)
+
+
+def is_routed(model):
+    """Check whether the router is responsible for a model."""
+    from facebook_insights.models import Insights
+
+    return model._meta.app_label == APP_LABEL or issubclass(model, Insights)
+
+
+class InsightsRouter(object):
+    """Route reads of metrics to FACEBOOK_INSIGHTS_READ_DATABASE and writes
+    to FACEBOOK_INSIGHTS_WRITE_DATABASE.
+    """
+
+    def db_for_read(self, model, **hints):
+        if is_routed(model):
+            return get_read_database()
+        return None
+
+    def db_for_write(self, model, **hints):
+        if is_routed(model):
+            return get_write_database()
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica mirrors the write database
+        aliases = set([get_read_database(), get_write_database()])
+        if ((is_routed(type(obj1)) or is_routed(type(obj2))) and
+                set([obj1._state.db, obj2._state.db]) <= aliases):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if not isinstance(app_label, six.string_types):  # Django 1.7
+            model = app_label
+            app_label = model._meta.app_label
+            model_name = model._meta.model_name
+        if app_label == APP_LABEL:
+            return db == get_write_database()
+        if model_name is None:
+            return None
+        try:
+            model = apps.get_model(app_label, model_name)
+        except LookupError:
+            return None
+        if is_routed(model):
+            return db == get_write_database()
+        return None
@@ -0,0 +1,128 @@
+"""Tools to decide when Insights objects should be fetched next time.
+
+Metrics of a post change fast during the first couple of days and hardly at
+all after a month, so refreshing all objects at the same rate wastes most of
+the requests. The interval between fetches is chosen based on:
+
+* the age of the object (see Insights.CREATED_TIME_FIELD) - the older the
+  object, the longer the interval;
+* the activity of the object, i.e. the relative change of its metric values
+  between the last two fetches - the interval is halved for objects whose
+  values changed noticeably and doubled for objects whose values didn't
+  change at all.
+
+>>> get_fetch_interval(age=timedelta(hours=5), activity=0.5)
+datetime.timedelta(0, 1800)
+>>> get_fetch_interval(age=timedelta(days=60), activity=0)
+datetime.timedelta(14)
+
+"""
+from datetime import timedelta
+from numbers import Number
+
+from django.utils import six
+
+from facebook_insights.json_codec import codec
+
+__all__ = ['DEFAULT_TIER', 'DEFAULT_FETCH_INTERVALS', 'get_activity',
+           'get_fetch_interval']
+
+DEFAULT_TIER = 'default'
+"""str: The name of the tier consisting of all metrics listed in METRICS."""
+
+DEFAULT_FETCH_INTERVALS = [
+    (timedelta(days=2), timedelta(hours=1)),
+    (timedelta(days=7), timedelta(hours=6)),
+    (timedelta(days=30), timedelta(days=1)),
+    (None, timedelta(days=7)),
+]
+"""list of tuple: Pairs of the maximum age of an object and the interval
+between fetches for objects younger than that. The maximum age of the last
+pair should be None.
+"""
+
+ACTIVITY_THRESHOLD = 0.1
+"""float: The relative change of values starting from which an object is
+considered active.
+"""
+
+
+def _get_numbers(value, path=''):
+    """Flatten a field value into a mapping of paths to numbers.
+
+    Values that are not numbers or dictionaries (or JSON representations of
+    those) are ignored.
+    """
+    if isinstance(value, bool):
+        return {}
+    if isinstance(value, Number):
+        return {path: value}
+    if isinstance(value, six.string_types):
+        try:
+            value = codec.loads(value)
+        except ValueError:
+            return {}
+        return _get_numbers(value, path)
+    numbers = {}
+    if isinstance(value, dict):
+        for key, item in value.items():
+            numbers.update(_get_numbers(item, '{}/{}'.format(path, key)))
+    return numbers
+
+
+def get_activity(old_values, new_values):
+    """Measure how much metric values have changed.
+
+    Parameters
+    ----------
+    old_values, new_values : dict
+        Mappings of field names to field values before and after a fetch.
+        Values can be numbers, dictionaries of numbers or their JSON
+        representations (as returned by Insights.get_field_value()).
+
+    Returns
+    -------
+    float or None
+        The sum of absolute changes of all numbers divided by the sum of
+        absolute old values. None, if there are no old values to compare to.
+
+    """
+    if not old_values:
+        return None
+    old_numbers = _get_numbers(old_values)
+    new_numbers = _get_numbers(new_values)
+    change = sum(abs(number - old_numbers.get(path, 0))
+                 for path, number in new_numbers.items())
+    total = sum(abs(number) for number in old_numbers.values())
+    return float(change) / max(total, 1)
+
+
+def get_fetch_interval(age, activity=None, intervals=None):
+    """Get the time to wait before fetching the object again.
+
+    Parameters
+    ----------
+    age : datetime.timedelta
+        The age of the object.
+    activity : float or None
+        The activity of the object as returned by get_activity().
+    intervals : list of tuple
+        Pairs of maximum ages and intervals. Defaults to
+        DEFAULT_FETCH_INTERVALS.
+
+    Returns
+    -------
+    datetime.timedelta
+
+    """
+    intervals = intervals or DEFAULT_FETCH_INTERVALS
+    for max_age, interval in intervals:
+        if max_age is None or age < max_age:
+            break
+    if activity is None:
+        return interval
+    if activity >= ACTIVITY_THRESHOLD:
+        return interval // 2
+    if activity == 0:
+        return interval * 2
+    return interval
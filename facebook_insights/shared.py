@@ -0,0 +1,143 @@
+"""Fetching metrics of several Insights models in one go.
+
+When several models store metrics of the same objects (e.g. a model with
+realtime metrics and a model with daily ones), fetching them separately
+requests the metrics they have in common twice. SharedFetch fetches the
+union of metrics of all registered querysets once per graph ID and puts the
+results into the fields of every instance:
+
+>>> shared_fetch = SharedFetch()
+>>> shared_fetch.register(PageRealtimeInsights.objects.all())
+>>> shared_fetch.register(PageDailyInsights.objects.all(),
+...                       metrics=['page_fans'])
+>>> realtime, daily = shared_fetch.fetch()
+>>> shared_fetch.save()
+
+Each model gets the same values as if it was fetched on its own: fields are
+filled with the model's get_field_name() and get_field_value(), and only the
+periods listed in the model's PERIODS are passed to them.
+
+"""
+from django.db import router, transaction
+
+from facebook_insights.derived import set_metrics_bulk
+from facebook_insights.metrics import Metric, fetch_metrics_by_id
+from facebook_insights.profiling import phase
+
+__all__ = ['SharedFetch']
+
+
+class SharedFetch(object):
+    """Fetch metrics for querysets of several Insights models at once."""
+
+    def __init__(self):
+        self.registrations = []
+        self.instances = []
+
+    def register(self, queryset, metrics=None):
+        """Add a queryset to fetch.
+
+        Parameters
+        ----------
+        queryset : InsightsQuerySet
+        metrics : iterable of str
+            Metrics to fetch for the queryset. Defaults to the model's
+            METRICS.
+
+        """
+        model = queryset.model
+        self.registrations.append((queryset, list(metrics or model.METRICS)))
+
+    def get_periods(self):
+        """Get periods to request for each metric.
+
+        A metric is requested for a single period only if all models
+        fetching it agree on the period. Otherwise it's requested for all
+        periods, and each model gets only those it wants.
+        """
+        periods_by_metric = {}
+        for queryset, metrics in self.registrations:
+            model_periods = queryset.model.PERIODS or {}
+            for metric in metrics:
+                periods_by_metric.setdefault(metric, set()).add(
+                    model_periods.get(metric)
+                )
+        return dict(
+            (metric, periods.pop())
+            for metric, periods in periods_by_metric.items()
+            if len(periods) == 1 and None not in periods
+        )
+
+    def fetch(self):
+        """Fetch metrics and put them into fields of the instances.
+
+        The instances are not saved (see save()).
+
+        Returns
+        -------
+        list of list
+            Instances of each registered queryset.
+
+        """
+        with phase('load'):
+            self.instances = [list(queryset._with_related_objects())
+                              for queryset, _ in self.registrations]
+        metrics_by_id = {}
+        for instances, (_, metrics) in zip(self.instances,
+                                           self.registrations):
+            for instance in instances:
+                id_metrics = metrics_by_id.setdefault(instance._graph_id, [])
+                for metric in metrics:
+                    if metric not in id_metrics:
+                        id_metrics.append(metric)
+        if not metrics_by_id:
+            return self.instances
+        periods = self.get_periods()
+        fetched_metrics = fetch_metrics_by_id(metrics_by_id.items(), periods)
+        with phase('map'):
+            for instances, (queryset, metrics) in zip(self.instances,
+                                                      self.registrations):
+                model_periods = queryset.model.PERIODS or {}
+                set_metrics_bulk(instances, [
+                    self.get_model_metrics(
+                        fetched_metrics.get(instance._graph_id, {}),
+                        metrics, model_periods, periods,
+                    )
+                    for instance in instances
+                ])
+        return self.instances
+
+    @staticmethod
+    def get_model_metrics(fetched_metrics, metrics, model_periods,
+                          requested_periods):
+        """Pick the metrics of a model out of the fetched ones.
+
+        Metrics requested for more periods than the model needs are trimmed
+        to the model's period.
+        """
+        model_metrics = {}
+        for metric_name in metrics:
+            metric = fetched_metrics.get(metric_name)
+            if metric is None:
+                continue
+            period = model_periods.get(metric_name)
+            if period and requested_periods.get(metric_name) != period:
+                if period not in metric.values:
+                    continue
+                metric = Metric(metric.name, {period: metric.values[period]})
+            model_metrics[metric_name] = metric
+        return model_metrics
+
+    def save(self):
+        """Save fetched metrics of all instances."""
+        for instances, (queryset, metrics) in zip(self.instances,
+                                                  self.registrations):
+            if not instances:
+                continue
+            update_fields = [instances[0].get_field_name(Metric(metric, {}))
+                             for metric in metrics]
+            update_fields.extend(instances[0].get_derived_field_names())
+            using = router.db_for_write(queryset.model)
+            with phase('save'), transaction.atomic(using=using):
+                for instance in instances:
+                    instance.save(update_fields=update_fields)
@@ -0,0 +1,278 @@
+"""Access token providers.
+
+A token provider decides which access token should be used to request
+metrics of an object. The provider is chosen based on the settings:
+
+* FACEBOOK_INSIGHTS_TOKEN_PROVIDER - the dotted path to a custom subclass
+  of 'BaseTokenProvider'. The class is instantiated without arguments.
+
+* FACEBOOK_INSIGHTS_TOKEN_MODEL - the label ('app_label.ModelName') of a model
+  storing page access tokens. Objects are looked up by their page ID in
+  the field named by FACEBOOK_INSIGHTS_TOKEN_MODEL_PAGE_ID_FIELD (default
+  'graph_id'), the token is taken from the field named by
+  FACEBOOK_INSIGHTS_TOKEN_MODEL_TOKEN_FIELD (default 'access_token').
+  Pages without a token fall back to the settings pool (see below).
+
+* Otherwise, tokens are taken from the settings pool consisting of
+  FACEBOOK_INSIGHTS_ACCESS_TOKENS (a list) and FACEBOOK_INSIGHTS_ACCESS_TOKEN.
+
+Tokens that get throttled are put aside for FACEBOOK_INSIGHTS_TOKEN_COOLDOWN
+seconds (default 600), expired tokens are removed for the rest of the process
+lifetime.
+
+Providers that read tokens from the database should implement prefetch(), so
+that code fetching metrics in background threads (see FetchPipeline) can load
+the tokens on the thread owning the database connection.
+
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from facebook_insights.exceptions import NoAccessToken
+
+__all__ = ['BaseTokenProvider', 'SettingsTokenProvider', 'ModelTokenProvider',
+           'get_page_id', 'token_provider']
+
+# Application, user, page and business use case rate limits
+THROTTLING_ERROR_CODES = frozenset(
+    [4, 17, 32, 613] + list(range(80001, 80010))
+)
+# The token is expired, invalidated or otherwise unusable
+EXPIRED_TOKEN_ERROR_CODES = frozenset([102, 190, 463, 467])
+
+
+def get_page_id(graph_id):
+    """Get the ID of the page an object belongs to.
+
+    IDs of page posts have form '<page_id>_<post_id>', IDs of pages
+    themselves are returned unchanged.
+    """
+    return graph_id.split('_')[0]
+
+
+class BaseTokenProvider(object):
+    """The base class for all token providers."""
+
+    def get_token(self, graph_id):
+        """Get an access token to request metrics of the object."""
+        raise NotImplementedError(
+            'Subclasses of BaseTokenProvider must implement get_token()'
+        )
+
+    def get_tokens(self, graph_ids):
+        """Get access tokens for several objects at once.
+
+        Returns
+        -------
+        dict
+            A mapping of graph IDs to access tokens.
+
+        """
+        return dict((graph_id, self.get_token(graph_id))
+                    for graph_id in graph_ids)
+
+    def report_error(self, token, error):
+        """Let the provider know that a request made with the token failed.
+
+        Parameters
+        ----------
+        token : str
+            The token the failed request was made with.
+        error : dict
+            The value of key "error" of a Graph API response.
+
+        Returns
+        -------
+        bool
+            True, if the token won't be provided any more (at least for some
+            time) and the request can be retried with another token.
+
+        """
+        return False
+
+    def prefetch(self, graph_ids):
+        """Load everything the provider needs from the database to provide
+        tokens for the objects.
+
+        Returns
+        -------
+        context manager
+            Tokens for the objects are provided from the loaded data, while
+            the context manager is active in the thread it's entered in.
+
+        """
+        return _nothing_prefetched()
+
+
+@contextmanager
+def _nothing_prefetched():
+    yield
+
+
+class SettingsTokenProvider(BaseTokenProvider):
+    """Distribute requests among a pool of tokens in round-robin fashion.
+
+    Parameters
+    ----------
+    tokens : iterable of str
+        The pool of access tokens.
+    cooldown : int
+        The number of seconds a throttled token is not provided for.
+
+    """
+
+    def __init__(self, tokens, cooldown=600):
+        self.tokens = list(tokens)
+        self.cooldown = cooldown
+        self._throttled_until = {}
+        self._next_index = 0
+        self._lock = threading.Lock()
+
+    def get_available_tokens(self):
+        now = time.time()
+        return [token for token in self.tokens
+                if self._throttled_until.get(token, 0) <= now]
+
+    def get_token(self, graph_id):
+        with self._lock:
+            available_tokens = self.get_available_tokens()
+            if not available_tokens:
+                raise NoAccessToken(
+                    'All access tokens are either expired or throttled.'
+                )
+            index = self._next_index % len(available_tokens)
+            self._next_index = index + 1
+            return available_tokens[index]
+
+    def report_error(self, token, error):
+        code = error.get('code')
+        with self._lock:
+            if token not in self.tokens:
+                return False
+            if code in THROTTLING_ERROR_CODES:
+                self._throttled_until[token] = time.time() + self.cooldown
+                return True
+            if code in EXPIRED_TOKEN_ERROR_CODES:
+                self.tokens.remove(token)
+                return True
+        return False
+
+
+class ModelTokenProvider(SettingsTokenProvider):
+    """Use page access tokens stored in a model, falling back to the pool.
+
+    Parameters
+    ----------
+    model : str
+        The label of the model in form 'app_label.ModelName'.
+    page_id_field : str
+        The name of the field storing page IDs.
+    token_field : str
+        The name of the field storing page access tokens.
+    tokens, cooldown
+        Same as for SettingsTokenProvider.
+
+    """
+
+    def __init__(self, model, page_id_field='graph_id',
+                 token_field='access_token', tokens=(), cooldown=600):
+        super(ModelTokenProvider, self).__init__(tokens, cooldown)
+        self.model = model
+        self.page_id_field = page_id_field
+        self.token_field = token_field
+        self._expired_page_tokens = set()
+        self._prefetched = threading.local()
+
+    def get_page_tokens(self, page_ids):
+        """Get a mapping of page IDs to their tokens with a single query."""
+        prefetched = getattr(self._prefetched, 'page_tokens', None)
+        if prefetched is not None:
+            return dict((page_id, token)
+                        for page_id, token in prefetched.items()
+                        if token not in self._expired_page_tokens)
+        model = apps.get_model(self.model)
+        lookup = {'{}__in'.format(self.page_id_field): set(page_ids)}
+        rows = model._default_manager.filter(**lookup).values_list(
+            self.page_id_field,
+            self.token_field,
+        )
+        return dict((page_id, token) for page_id, token in rows
+                    if token and token not in self._expired_page_tokens)
+
+    def get_token(self, graph_id):
+        return self.get_tokens([graph_id])[graph_id]
+
+    def get_tokens(self, graph_ids):
+        page_ids = dict((graph_id, get_page_id(graph_id))
+                        for graph_id in graph_ids)
+        page_tokens = self.get_page_tokens(page_ids.values())
+        tokens = {}
+        for graph_id, page_id in page_ids.items():
+            if page_id in page_tokens:
+                tokens[graph_id] = page_tokens[page_id]
+            else:
+                tokens[graph_id] = super(ModelTokenProvider, self).get_token(
+                    graph_id
+                )
+        return tokens
+
+    def prefetch(self, graph_ids):
+        page_tokens = self.get_page_tokens(
+            set(get_page_id(graph_id) for graph_id in graph_ids)
+        )
+        return self._use_page_tokens(page_tokens)
+
+    @contextmanager
+    def _use_page_tokens(self, page_tokens):
+        self._prefetched.page_tokens = page_tokens
+        try:
+            yield
+        finally:
+            del self._prefetched.page_tokens
+
+    def report_error(self, token, error):
+        if token in self.tokens:
+            return super(ModelTokenProvider, self).report_error(token, error)
+        # Page tokens are tied to their pages, so the only thing we can do
+        # with a throttled one is wait. Expired ones are replaced with
+        # tokens from the pool.
+        if error.get('code') in EXPIRED_TOKEN_ERROR_CODES:
+            self._expired_page_tokens.add(token)
+            return True
+        return False
+
+
+def get_token_provider():
+    """Create a token provider based on the settings."""
+    provider_path = getattr(settings, 'FACEBOOK_INSIGHTS_TOKEN_PROVIDER', None)
+    if provider_path:
+        return import_string(provider_path)()
+    tokens = list(getattr(settings, 'FACEBOOK_INSIGHTS_ACCESS_TOKENS', []))
+    access_token = getattr(settings, 'FACEBOOK_INSIGHTS_ACCESS_TOKEN', None)
+    if access_token and access_token not in tokens:
+        tokens.append(access_token)
+    cooldown = getattr(settings, 'FACEBOOK_INSIGHTS_TOKEN_COOLDOWN', 600)
+    token_model = getattr(settings, 'FACEBOOK_INSIGHTS_TOKEN_MODEL', None)
+    if token_model:
+        return ModelTokenProvider(
+            model=token_model,
+            page_id_field=getattr(
+                settings, 'FACEBOOK_INSIGHTS_TOKEN_MODEL_PAGE_ID_FIELD',
+                'graph_id'
+            ),
+            token_field=getattr(
+                settings, 'FACEBOOK_INSIGHTS_TOKEN_MODEL_TOKEN_FIELD',
+                'access_token'
+            ),
+            tokens=tokens,
+            cooldown=cooldown,
+        )
+    return SettingsTokenProvider(tokens, cooldown)
+
+
+token_provider = get_token_provider()
@@ -1,9 +1,10 @@
 from django.db import models
 
+from facebook_insights.derived import Fetched, Previous
 from facebook_insights.models import Insights
 
-__all__ = ['PostInsights', 'PageInsights', 'PostInsightsWithoutGraphID',
-           'Post']
+__all__ = ['PostInsights', 'PostEngagementInsights', 'PageInsights',
+           'PageDailyInsights', 'PostInsightsWithoutGraphID', 'Post', 'Page']
 
 
 class PostInsights(Insights):
@@ -32,6 +33,27 @@ class PostInsights(Insights):
     storytellers = models.PositiveIntegerField(null=True)
 
 
+class PostEngagementInsights(Insights):
+    METRICS = [
+        'post_stories',
+        'post_impressions_unique',
+    ]
+    DERIVED_METRICS = {
+        'engagement_rate': (Fetched('post_stories') /
+                            Fetched('post_impressions_unique')),
+        'stories_change': Fetched('post_stories') - Previous('stories'),
+    }
+    graph_id = models.CharField(
+        max_length=100,
+        unique=True,
+        help_text="The page post ID on Facebook",
+    )
+    stories = models.PositiveIntegerField(null=True)
+    impressions_unique = models.PositiveIntegerField(null=True)
+    engagement_rate = models.FloatField(null=True)
+    stories_change = models.IntegerField(null=True)
+
+
 class PageInsights(Insights):
     METRICS = [
         'page_engaged_users',
@@ -50,6 +72,23 @@ class PageInsights(Insights):
     posts_impressions = models.CharField(null=True, max_length=80)
 
 
+class PageDailyInsights(Insights):
+    METRICS = [
+        'page_impressions',
+        'page_fans',
+    ]
+    PERIODS = {
+        'page_impressions': 'day',
+    }
+    graph_id = models.CharField(
+        max_length=100,
+        unique=True,
+        help_text="The page ID on Facebook",
+    )
+    impressions = models.IntegerField(null=True)
+    fans = models.CharField(null=True, max_length=80)
+
+
 class Post(models.Model):
     graph_id = models.CharField(
         max_length=100,
@@ -61,3 +100,12 @@ class Post(models.Model):
 class PostInsightsWithoutGraphID(Insights):
     RELATED_OBJECT_FIELD = 'post'
     post = models.OneToOneField(Post)
+
+
+class Page(models.Model):
+    graph_id = models.CharField(
+        max_length=100,
+        unique=True,
+        help_text="The page ID on Facebook",
+    )
+    access_token = models.CharField(max_length=255, blank=True)
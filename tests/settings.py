@@ -16,6 +16,7 @@ SECRET_KEY = 'dummy-key'
 USE_TZ = True  # Prevents some ValueError's with SQLite backend
 
 INSTALLED_APPS = [
+    'django.contrib.contenttypes',
     'facebook_insights',
     'tests',
 ]
@@ -28,6 +29,23 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+    },
+    'analytics': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db-analytics.sqlite3'),
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
 
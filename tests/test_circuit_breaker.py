@@ -0,0 +1,131 @@
+"""Tests for the 'facebook_insights.circuit_breaker' module."""
+import requests
+from django.core.cache import caches
+from django.test import TestCase
+from facebook import GraphAPIError
+
+from facebook_insights.circuit_breaker import (CLOSED, HALF_OPEN, OPEN,
+                                               CircuitBreaker,
+                                               circuit_state_changed,
+                                               is_failure)
+from facebook_insights.exceptions import CircuitOpen
+
+try:  # Python 3.3+
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+def fail():
+    raise requests.ConnectionError('Connection refused')
+
+
+def succeed():
+    return 'ok'
+
+
+class TestCircuitBreaker(TestCase):
+    """Tests for the 'CircuitBreaker' class."""
+
+    def setUp(self):
+        caches['default'].clear()
+        self.time = 1000.0
+        patcher = mock.patch('time.time', side_effect=lambda: self.time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_circuit_breaker(self, **kwargs):
+        options = {'window': 60, 'min_calls': 4, 'failure_rate': 0.5,
+                   'slow_call_duration': 10, 'open_timeout': 30}
+        options.update(kwargs)
+        return CircuitBreaker('test', **options)
+
+    def open_circuit(self, circuit_breaker):
+        for _ in range(circuit_breaker.min_calls):
+            with self.assertRaises(requests.ConnectionError):
+                circuit_breaker.call(fail)
+
+    def test_opens_on_failures_and_fails_fast(self):
+        circuit_breaker = self.make_circuit_breaker()
+        circuit_breaker.call(succeed)
+        circuit_breaker.call(succeed)
+        with self.assertRaises(requests.ConnectionError):
+            circuit_breaker.call(fail)
+        self.assertEqual(circuit_breaker.state, CLOSED)
+        with self.assertRaises(requests.ConnectionError):
+            circuit_breaker.call(fail)
+        self.assertEqual(circuit_breaker.state, OPEN)
+        func = mock.Mock()
+        with self.assertRaises(CircuitOpen):
+            circuit_breaker.call(func)
+        self.assertFalse(func.called)
+
+    def test_opens_on_slow_calls(self):
+        circuit_breaker = self.make_circuit_breaker()
+
+        def slow():
+            self.time += 15
+        for _ in range(4):
+            circuit_breaker.call(slow)
+        self.assertEqual(circuit_breaker.state, OPEN)
+
+    def test_old_calls_are_forgotten(self):
+        circuit_breaker = self.make_circuit_breaker()
+        for _ in range(3):
+            with self.assertRaises(requests.ConnectionError):
+                circuit_breaker.call(fail)
+        self.time += 120
+        circuit_breaker.call(succeed)
+        self.assertEqual(circuit_breaker.state, CLOSED)
+
+    def test_half_open_probe(self):
+        circuit_breaker = self.make_circuit_breaker()
+        self.open_circuit(circuit_breaker)
+        self.time += 31
+        self.assertEqual(circuit_breaker.state, HALF_OPEN)
+        # A failed probe opens the circuit again
+        with self.assertRaises(requests.ConnectionError):
+            circuit_breaker.call(fail)
+        self.assertEqual(circuit_breaker.state, OPEN)
+        self.time += 31
+        # Only one probe is let through at a time
+        circuit_breaker._acquire_probe()
+        with self.assertRaises(CircuitOpen):
+            circuit_breaker.call(succeed)
+        circuit_breaker._release_probe()
+        # A successful probe closes the circuit
+        self.assertEqual(circuit_breaker.call(succeed), 'ok')
+        self.assertEqual(circuit_breaker.state, CLOSED)
+
+    def test_state_changes_are_announced(self):
+        handler = mock.Mock()
+        circuit_state_changed.connect(handler)
+        self.addCleanup(circuit_state_changed.disconnect, handler)
+        circuit_breaker = self.make_circuit_breaker()
+        self.open_circuit(circuit_breaker)
+        handler.assert_called_once_with(
+            signal=circuit_state_changed,
+            sender=circuit_breaker,
+            old_state=CLOSED,
+            new_state=OPEN,
+        )
+
+    def test_state_is_shared_through_cache(self):
+        first = self.make_circuit_breaker(cache='default')
+        second = self.make_circuit_breaker(cache='default')
+        self.open_circuit(first)
+        self.assertEqual(second.state, OPEN)
+        self.time += 31
+        self.assertTrue(first._acquire_probe())
+        self.assertFalse(second._acquire_probe())
+
+    def test_is_failure(self):
+        self.assertTrue(is_failure(requests.Timeout()))
+        self.assertTrue(is_failure(GraphAPIError('Maintype was not text')))
+        self.assertTrue(is_failure(GraphAPIError({'error': {'code': 2}})))
+        self.assertTrue(is_failure(GraphAPIError(
+            {'error': {'code': 100, 'is_transient': True}}
+        )))
+        self.assertFalse(is_failure(GraphAPIError({'error': {'code': 100}})))
+        self.assertFalse(is_failure(GraphAPIError({'error': {'code': 4}})))
+        self.assertFalse(is_failure(ValueError()))
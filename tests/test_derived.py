@@ -0,0 +1,109 @@
+"""Tests for the 'facebook_insights.derived' module."""
+from django.test import TestCase
+
+from facebook_insights import models as models_module
+from facebook_insights.derived import Fetched, Previous, set_metrics_bulk
+from facebook_insights.metrics import Metric
+from facebook_insights.pipeline import FetchPipeline
+from tests.models import PageInsights, PostEngagementInsights
+
+try:  # Python 3.3+
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+def make_post_metrics(stories, impressions_unique):
+    metrics = {}
+    for name, value in [('post_stories', stories),
+                        ('post_impressions_unique', impressions_unique)]:
+        if value is not None:
+            metrics[name] = Metric(name, {'lifetime': [{'value': value}]})
+    return metrics
+
+
+class TestExpressions(TestCase):
+    """Tests for evaluation of expressions."""
+
+    def test_operations(self):
+        expression = (Fetched('a') + 1) * 2 - Previous('b') / Fetched('c')
+        columns = {
+            ('fetched', 'a', None, -1): [1, 2, None],
+            ('previous', 'b'): [3, 0, 1],
+            ('fetched', 'c', None, -1): [3, 0, 1],
+        }
+        # Division by zero and missing values give None
+        self.assertEqual(expression.evaluate(columns, 3), [3.0, None, None])
+
+    def test_right_hand_operations(self):
+        expression = 10 / Fetched('a') - 1
+        columns = {('fetched', 'a', None, -1): [4]}
+        self.assertEqual(expression.evaluate(columns, 1), [1.5])
+
+    def test_repr(self):
+        expression = Fetched('a') / (Fetched('b', 'day', -2) + 1)
+        self.assertEqual(repr(expression),
+                         "(Fetched('a') / (Fetched('b', 'day', -2) + 1))")
+
+    def test_fetched_values_with_periods_and_indexes(self):
+        metrics = {'page_impressions': Metric('page_impressions', {
+            'day': [{'value': 1}, {'value': 2}, {'value': 3}],
+            'week': [{'value': 10}, {'value': 20}, {'value': 30}],
+        })}
+        self.assertEqual(Fetched('page_impressions', 'day', -2).read(metrics),
+                         2)
+        self.assertEqual(Fetched('page_impressions', 'week').read(metrics),
+                         30)
+        # The period can't be omitted for metrics with several periods
+        self.assertIsNone(Fetched('page_impressions').read(metrics))
+        self.assertIsNone(Fetched('page_engaged_users').read(metrics))
+
+
+class TestDerivedMetrics(TestCase):
+    """Tests for computing derived metrics on fetch."""
+
+    def setUp(self):
+        self.instances = [
+            PostEngagementInsights.objects.create(graph_id='1_1', stories=5),
+            PostEngagementInsights.objects.create(graph_id='1_2'),
+            PostEngagementInsights.objects.create(graph_id='1_3',
+                                                  stories_change=7),
+        ]
+
+    def test_derived_metrics_are_computed_for_all_instances(self):
+        set_metrics_bulk(self.instances, [
+            make_post_metrics(10, 200),
+            make_post_metrics(3, 0),
+            make_post_metrics(None, 100),
+        ])
+        first, second, third = self.instances
+        self.assertEqual(first.stories, 10)
+        self.assertEqual(first.engagement_rate, 0.05)
+        # Previous values are read before fetched ones are set
+        self.assertEqual(first.stories_change, 5)
+        # Operands that are missing leave fields untouched
+        self.assertIsNone(second.engagement_rate)
+        self.assertIsNone(second.stories_change)
+        self.assertIsNone(third.engagement_rate)
+        self.assertEqual(third.stories_change, 7)
+
+    def test_missing_field_raises(self):
+        with mock.patch.object(PageInsights, 'DERIVED_METRICS', {
+            'engagement_rate': Fetched('page_engaged_users'),
+        }):
+            with self.assertRaises(AttributeError):
+                set_metrics_bulk([PageInsights(graph_id='1')], [{}])
+
+    def test_derived_metrics_are_saved_by_pipeline(self):
+        def fake_fetch_metrics_bulk(graph_ids, metrics, periods=None):
+            return dict((graph_id, make_post_metrics(10, 100))
+                        for graph_id in graph_ids)
+
+        with mock.patch.object(models_module, 'fetch_metrics_bulk',
+                               side_effect=fake_fetch_metrics_bulk):
+            FetchPipeline(PostEngagementInsights.objects.all()).run()
+        values = PostEngagementInsights.objects.order_by('graph_id')
+        self.assertEqual(
+            list(values.values_list('engagement_rate', 'stories_change')),
+            [(0.1, 5), (0.1, None), (0.1, 7)]
+        )
@@ -0,0 +1,76 @@
+"""Tests for planning fetches with explain_fetch()."""
+from django.core.cache import caches
+from django.test import TestCase
+
+from facebook_insights import metrics as metrics_module
+from facebook_insights.metrics import explain_fetch
+from facebook_insights.negative_cache import NegativeCache
+from facebook_insights.tokens import SettingsTokenProvider
+from tests.models import Post, PostInsights, PostInsightsWithoutGraphID
+
+try:  # Python 3.3+
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class TestExplainFetch(TestCase):
+    """Tests for explain_fetch() and its model and queryset counterparts."""
+
+    def setUp(self):
+        caches['default'].clear()
+        patchers = [
+            mock.patch.object(metrics_module, 'negative_cache',
+                              NegativeCache(cache_alias='default')),
+            mock.patch.object(metrics_module, 'token_provider',
+                              SettingsTokenProvider(['a', 'b', 'c'])),
+            mock.patch.object(metrics_module, 'get_graph_api'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.negative_cache = metrics_module.negative_cache
+        self.get_graph_api = metrics_module.get_graph_api
+
+    def test_plan(self):
+        graph_ids = [str(i) for i in range(30)]
+        self.negative_cache.add('0', 'page_impressions')
+        self.negative_cache.add('0', 'page_fans')
+        self.negative_cache.add('1', 'page_fans')
+        plan = explain_fetch(graph_ids, ['page_impressions', 'page_fans'])
+        self.assertEqual(plan.as_dict(), {
+            'objects': 29,
+            'requests': 57,
+            'batches': 2,
+            'negative_cache_hits': 3,
+            'tokens': 3,
+            'cost': 57,
+        })
+        self.assertFalse(self.get_graph_api.called)
+
+    def test_plan_without_requests(self):
+        self.negative_cache.add('0', 'page_fans')
+        plan = explain_fetch(['0'], ['page_fans'])
+        self.assertEqual((plan.requests, plan.batches, plan.tokens),
+                         (0, 0, None))
+
+    def test_model_and_queryset(self):
+        for i in range(3):
+            PostInsights.objects.create(graph_id='1_{}'.format(i))
+        plan = PostInsights.objects.all().explain_fetch()
+        self.assertEqual(plan.objects, 3)
+        self.assertEqual(plan.requests, 3 * len(PostInsights.METRICS))
+        plan = PostInsights(graph_id='1_1').explain_fetch(['post_stories'])
+        self.assertEqual((plan.objects, plan.requests), (1, 1))
+        self.assertEqual(repr(plan + plan), '<FetchPlan: 2 objects, 2 '
+                         'requests in 2 batches, 0 negative cache hits, '
+                         '1 tokens>')
+        self.assertFalse(self.get_graph_api.called)
+
+    def test_queryset_with_related_object(self):
+        post = Post.objects.create(graph_id='1_1')
+        PostInsightsWithoutGraphID.objects.create(post=post)
+        plan = PostInsightsWithoutGraphID.objects.all().explain_fetch(
+            ['post_stories']
+        )
+        self.assertEqual((plan.objects, plan.requests), (1, 1))
@@ -0,0 +1,159 @@
+"""Tests for the 'facebook_insights.history' module."""
+from datetime import datetime, timedelta
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import six, timezone
+
+from facebook_insights.history import (DAY, MONTH, WEEK, downsample,
+                                       drop_expired, get_bucket_start,
+                                       record_metrics)
+from facebook_insights.metrics import Metric
+from facebook_insights.models import MetricValue
+from tests.models import PageInsights
+
+try:  # Python 3.3+
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+def utc_datetime(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+def make_page_metric(name, start, days, period='day'):
+    values = [
+        {'end_time': (start + timedelta(days=day)).strftime(
+            '%Y-%m-%dT%H:%M:%S+0000'), 'value': day + 1}
+        for day in range(days)
+    ]
+    return Metric(name, {period: values})
+
+
+class TestHistory(TestCase):
+    """Tests for recording, downsampling and removing history."""
+
+    def setUp(self):
+        self.page_insights = PageInsights.objects.create(graph_id='1')
+        self.content_type = ContentType.objects.get_for_model(PageInsights)
+
+    def test_values_are_recorded_on_save(self):
+        metric = make_page_metric('page_impressions',
+                                  utc_datetime(2016, 11, 15, 8), 3)
+        with mock.patch.object(PageInsights, 'KEEP_HISTORY', True):
+            page_insights = PageInsights.objects.get(pk=self.page_insights.pk)
+            page_insights.set_metrics({'page_impressions': metric})
+            page_insights.save()
+            # Values are recorded only once
+            page_insights.save()
+        values = MetricValue.objects.order_by('end_time')
+        self.assertEqual([value.get_value() for value in values], [1, 2, 3])
+        self.assertEqual(values[0].end_time, utc_datetime(2016, 11, 15, 8))
+        self.assertEqual(values[0].object_id, str(self.page_insights.pk))
+
+    def test_history_is_not_kept_by_default(self):
+        metric = make_page_metric('page_impressions',
+                                  utc_datetime(2016, 11, 15, 8), 3)
+        self.page_insights.set_metrics({'page_impressions': metric})
+        self.page_insights.save()
+        self.assertFalse(MetricValue.objects.exists())
+
+    def test_overlapping_values_are_overwritten(self):
+        start = utc_datetime(2016, 11, 15, 8)
+        record_metrics(self.page_insights, {
+            'page_impressions': make_page_metric('page_impressions', start, 3),
+        })
+        metric = make_page_metric('page_impressions',
+                                  start + timedelta(days=1), 3)
+        record_metrics(self.page_insights, {'page_impressions': metric})
+        values = MetricValue.objects.order_by('end_time')
+        self.assertEqual([value.get_value() for value in values],
+                         [1, 1, 2, 3])
+
+    def test_lifetime_and_non_numeric_values(self):
+        fetched_at = utc_datetime(2016, 11, 15)
+        metric = Metric('post_stories_by_action_type',
+                        {'lifetime': [{'value': {'like': 1}}]})
+        record_metrics(self.page_insights, {metric.name: metric}, fetched_at)
+        value = MetricValue.objects.get()
+        self.assertEqual(value.end_time, fetched_at)
+        self.assertIsNone(value.value)
+        self.assertEqual(value.get_value(), {'like': 1})
+
+    def test_get_bucket_start(self):
+        moment = utc_datetime(2016, 11, 17, 8)  # Thursday
+        self.assertEqual(get_bucket_start(moment, WEEK),
+                         utc_datetime(2016, 11, 14))
+        self.assertEqual(get_bucket_start(moment, MONTH),
+                         utc_datetime(2016, 11, 1))
+
+    def test_downsample(self):
+        start = utc_datetime(2016, 11, 14, 8)  # Monday
+        record_metrics(self.page_insights, {
+            'page_impressions': make_page_metric('page_impressions', start,
+                                                 10),
+            'page_fans': make_page_metric('page_fans', start, 10,
+                                          period='lifetime'),
+        })
+        removed, created = downsample(DAY, WEEK, utc_datetime(2016, 11, 30))
+        # 2 weeks of daily values for 2 metrics are downsampled
+        self.assertEqual((removed, created), (20, 4))
+        weekly = MetricValue.objects.filter(resolution=WEEK)
+        impressions = weekly.filter(metric='page_impressions')
+        fans = weekly.filter(metric='page_fans')
+        # Daily values are summed up, cumulative ones keep the last value
+        self.assertEqual(
+            [value.value for value in impressions.order_by('end_time')],
+            [sum(range(1, 8)), 8 + 9 + 10]
+        )
+        self.assertEqual(
+            [value.value for value in fans.order_by('end_time')],
+            [7, 10]
+        )
+        self.assertFalse(MetricValue.objects.filter(resolution=DAY).exists())
+
+    def test_downsample_keeps_incomplete_buckets(self):
+        start = utc_datetime(2016, 11, 14, 8)
+        record_metrics(self.page_insights, {
+            'page_impressions': make_page_metric('page_impressions', start,
+                                                 10),
+        })
+        # The second week isn't over by the cutoff, so it stays intact
+        removed, created = downsample(DAY, WEEK, utc_datetime(2016, 11, 22))
+        self.assertEqual((removed, created), (7, 1))
+        self.assertEqual(MetricValue.objects.filter(resolution=DAY).count(),
+                         3)
+
+    def test_drop_expired(self):
+        start = utc_datetime(2016, 11, 14, 8)
+        record_metrics(self.page_insights, {
+            'page_impressions': make_page_metric('page_impressions', start,
+                                                 10),
+        })
+        self.assertEqual(drop_expired(utc_datetime(2016, 11, 20)), [])
+        self.assertEqual(MetricValue.objects.count(), 4)
+
+    def test_retention_command(self):
+        now = timezone.now()
+        record_metrics(self.page_insights, {
+            'page_impressions': make_page_metric(
+                'page_impressions', now - timedelta(days=500), 500,
+            ),
+        })
+        stdout = six.StringIO()
+        call_command('insights_retention', keep=400, stdout=stdout)
+        self.assertIn('Downsampled', stdout.getvalue())
+        oldest = MetricValue.objects.order_by('end_time')[0].end_time
+        self.assertGreaterEqual(oldest, now - timedelta(days=400))
+        # Daily values are kept for whole weeks at most 90 days old
+        self.assertFalse(
+            MetricValue.objects.filter(
+                resolution=DAY,
+                end_time__lt=now - timedelta(days=90 + 7),
+            ).exists()
+        )
+        self.assertTrue(
+            MetricValue.objects.filter(resolution=MONTH).exists()
+        )
@@ -0,0 +1,41 @@
+"""Tests for the 'facebook_insights.json_codec' module."""
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+
+from facebook_insights.json_codec import JSONCodec, OrjsonCodec, get_codec
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class TestGetCodec(TestCase):
+    """Tests for the 'get_codec' function."""
+
+    def test_json(self):
+        codec = get_codec('json')
+        self.assertIsInstance(codec, JSONCodec)
+        self.assertEqual(codec.loads(codec.dumps({'day': [1, 2]})),
+                         {'day': [1, 2]})
+
+    def test_dotted_path(self):
+        self.assertIs(get_codec('facebook_insights.json_codec.JSONCodec'),
+                      JSONCodec)
+
+    def test_default(self):
+        codec = get_codec()
+        if orjson is None:
+            self.assertIsInstance(codec, JSONCodec)
+        else:
+            self.assertIsInstance(codec, OrjsonCodec)
+
+    def test_orjson(self):
+        if orjson is None:
+            with self.assertRaises(ImproperlyConfigured):
+                get_codec('orjson')
+            return
+        codec = get_codec('orjson')
+        # dumps() must return text rather than bytes
+        self.assertEqual(codec.dumps({'like': 1}), '{"like":1}')
+        self.assertEqual(codec.loads('{"like":1}'), {'like': 1})
@@ -3,11 +3,19 @@
 # * Ensure that all test have appropriate names
 # * Check/add docstrings where it's needed
 # * Rearrange
+import json
+
 from django.test import TestCase
 
+from facebook_insights import metrics as metrics_module
 from facebook_insights.exceptions import MetricsNotSpecified
 from facebook_insights.metrics import fetch_metrics, Metric
 
+try:  # Python 3.3+
+    from unittest import mock
+except ImportError:
+    import mock
+
 TEST_PAGE_ID = '327730534261730'
 TEST_POST_ID = '327730534261730_327732570928193'
 
@@ -87,6 +95,34 @@ class TestFetchMetric(TestCase):
         test_post_metric('post_impressions_fan')
 
 
+class TestBatchRequest(TestCase):
+    """Tests for the format of batch requests made by fetch_metrics()."""
+
+    def test_periods_and_headers(self):
+        body = json.dumps({'data': [{
+            'name': 'page_impressions',
+            'period': 'day',
+            'values': [{'value': 1}],
+        }]})
+        graph_api = mock.Mock()
+        graph_api.put_object.return_value = [{'code': 200, 'body': body}] * 2
+        with mock.patch.object(metrics_module, 'get_graph_api',
+                               return_value=graph_api):
+            fetch_metrics(
+                graph_id=TEST_PAGE_ID,
+                metrics=['page_impressions', 'page_fans'],
+                periods={'page_impressions': 'day'},
+            )
+        kwargs = graph_api.put_object.call_args[1]
+        self.assertEqual(kwargs['include_headers'], 'false')
+        batch = json.loads(kwargs['batch'])
+        self.assertEqual(
+            [request['relative_url'] for request in batch],
+            ['{}/insights/page_impressions/?period=day'.format(TEST_PAGE_ID),
+             '{}/insights/page_fans/'.format(TEST_PAGE_ID)]
+        )
+
+
 class TestMetric(TestCase):
     """Tests for the 'Metric' class."""
 
@@ -9,6 +9,11 @@ from facebook_insights.metrics import Metric
 from tests.models import (PageInsights, PostInsights, Post,
                           PostInsightsWithoutGraphID)
 
+try:  # Python 3.3+
+    from unittest import mock
+except ImportError:
+    import mock
+
 TEST_PAGE_ID = '327730534261730'
 TEST_POST_ID = '327730534261730_327732570928193'
 
@@ -99,6 +104,31 @@ class TestInsights(TestCase):
             '{"day": 2, "week": 12, "days_28": 102}'
         )
 
+    def test_get_field_value_of_json_field(self):
+        """Values of fields storing JSON natively shouldn't be serialized."""
+        post_insights = self.post_insights
+        metric = Metric(
+            name='post_stories_by_action_type',
+            values={'lifetime': [{'value': {'like': 1}}]}
+        )
+        self.assertJSONEqual(post_insights.get_field_value(metric),
+                             '{"like": 1}')
+        with mock.patch.object(PostInsights, 'get_json_field_names',
+                               return_value={'stories_by_action_type'}):
+            self.assertEqual(post_insights.get_field_value(metric),
+                             {'like': 1})
+
+    def test_get_decoded_value(self):
+        post_insights = self.post_insights
+        post_insights.impressions = 10
+        post_insights.stories_by_action_type = '{"like": 1}'
+        self.assertEqual(post_insights.get_decoded_value('impressions'), 10)
+        self.assertEqual(
+            post_insights.get_decoded_value('stories_by_action_type'),
+            {'like': 1}
+        )
+        self.assertEqual(PostInsights.get_json_field_names(), frozenset())
+
     def test_fetch_post_insights(self):
         """Test method fetch() by fetching some post metrics."""
         post_insights = self.post_insights
@@ -0,0 +1,157 @@
+"""Tests for the 'facebook_insights.negative_cache' module."""
+import json
+
+from django.core.cache import caches
+from django.test import TestCase
+
+from facebook_insights import metrics as metrics_module
+from facebook_insights.exceptions import EmptyData
+from facebook_insights.metrics import fetch_metrics, fetch_metrics_bulk
+from facebook_insights.negative_cache import NegativeCache, is_permanent_error
+
+try:  # Python 3.3+
+    from unittest import mock
+except ImportError:
+    import mock
+
+TEST_PAGE_ID = '327730534261730'
+
+
+def make_response(body):
+    return {'code': 200, 'body': json.dumps(body)}
+
+
+class TestNegativeCache(TestCase):
+    """Tests for the 'NegativeCache' class."""
+
+    def setUp(self):
+        caches['default'].clear()
+        self.negative_cache = NegativeCache(
+            cache_alias='default',
+            timeout=100,
+            max_timeout=300,
+        )
+
+    def test_disabled_cache_skips_nothing(self):
+        negative_cache = NegativeCache(cache_alias=None)
+        negative_cache.add(TEST_PAGE_ID, 'page_impressions')
+        self.assertEqual(
+            negative_cache.filter(TEST_PAGE_ID, ['page_impressions']),
+            ['page_impressions']
+        )
+
+    def test_filter_removes_cached_metrics(self):
+        negative_cache = self.negative_cache
+        negative_cache.add(TEST_PAGE_ID, 'page_impressions')
+        self.assertEqual(
+            negative_cache.filter(
+                TEST_PAGE_ID,
+                ['page_impressions', 'page_engaged_users'],
+            ),
+            ['page_engaged_users']
+        )
+        # Other objects shouldn't be affected
+        self.assertEqual(
+            negative_cache.filter('42', ['page_impressions']),
+            ['page_impressions']
+        )
+        negative_cache.remove(TEST_PAGE_ID, 'page_impressions')
+        self.assertEqual(
+            negative_cache.filter(TEST_PAGE_ID, ['page_impressions']),
+            ['page_impressions']
+        )
+
+    def test_timeout_grows_with_every_failure(self):
+        negative_cache = self.negative_cache
+        now = 1000000.0
+        with mock.patch('time.time') as time_mock:
+            # A pair is skipped for 100, 200 and then at most 300 seconds,
+            # and requested again in between.
+            for timeout in [100, 200, 300, 300]:
+                time_mock.return_value = now
+                negative_cache.add(TEST_PAGE_ID, 'page_impressions')
+                time_mock.return_value = now + timeout - 1
+                self.assertEqual(
+                    negative_cache.filter(TEST_PAGE_ID, ['page_impressions']),
+                    []
+                )
+                now += timeout + 1
+                time_mock.return_value = now
+                self.assertEqual(
+                    negative_cache.filter(TEST_PAGE_ID, ['page_impressions']),
+                    ['page_impressions']
+                )
+
+    def test_is_permanent_error(self):
+        self.assertTrue(is_permanent_error({'code': 100}))
+        self.assertTrue(is_permanent_error({'code': 10}))
+        self.assertTrue(is_permanent_error({'code': 200}))
+        self.assertFalse(is_permanent_error({'code': 100,
+                                             'is_transient': True}))
+        # Rate limiting and expired tokens have nothing to do with the object
+        self.assertFalse(is_permanent_error({'code': 4}))
+        self.assertFalse(is_permanent_error({'code': 17}))
+        self.assertFalse(is_permanent_error({'code': 190}))
+
+
+class TestFetchMetricsWithNegativeCache(TestCase):
+    """Tests for the negative cache integration in fetch_metrics()."""
+
+    def setUp(self):
+        caches['default'].clear()
+        negative_cache = NegativeCache(cache_alias='default')
+        patcher = mock.patch.object(metrics_module, 'negative_cache',
+                                    negative_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.negative_cache = negative_cache
+
+    def test_empty_data_is_cached_and_skipped(self):
+        impressions = make_response({'data': [{
+            'name': 'page_impressions',
+            'period': 'day',
+            'values': [{'value': 1}],
+        }]})
+        empty = make_response({'data': []})
+        graph_api = mock.Mock()
+        with mock.patch.object(metrics_module, 'get_graph_api',
+                               return_value=graph_api):
+            graph_api.put_object.return_value = [impressions, empty]
+            with self.assertRaises(EmptyData):
+                fetch_metrics(TEST_PAGE_ID,
+                              ['page_impressions', 'page_engaged_users'])
+            graph_api.put_object.return_value = [impressions]
+            fetched = fetch_metrics(TEST_PAGE_ID,
+                                    ['page_impressions', 'page_engaged_users'])
+            batch = json.loads(graph_api.put_object.call_args[1]['batch'])
+        self.assertEqual(len(batch), 1)
+        self.assertIn('page_impressions', batch[0]['relative_url'])
+        self.assertEqual(list(fetched), ['page_impressions'])
+
+    def test_raises_without_request_if_all_metrics_are_cached(self):
+        self.negative_cache.add(TEST_PAGE_ID, 'page_impressions')
+        graph_api = mock.Mock()
+        with mock.patch.object(metrics_module, 'get_graph_api',
+                               return_value=graph_api):
+            with self.assertRaises(EmptyData):
+                fetch_metrics(TEST_PAGE_ID, ['page_impressions'])
+            self.assertFalse(graph_api.put_object.called)
+
+    def test_incomplete_requests_are_not_cached(self):
+        impressions = make_response({'data': [{
+            'name': 'page_impressions',
+            'period': 'day',
+            'values': [{'value': 1}],
+        }]})
+        graph_api = mock.Mock()
+        graph_api.put_object.return_value = [impressions, None]
+        with mock.patch.object(metrics_module, 'get_graph_api',
+                               return_value=graph_api):
+            fetched = fetch_metrics_bulk([TEST_PAGE_ID, '42'],
+                                         ['page_impressions'])
+        self.assertEqual(list(fetched[TEST_PAGE_ID]), ['page_impressions'])
+        self.assertEqual(fetched['42'], {})
+        self.assertEqual(
+            self.negative_cache.filter('42', ['page_impressions']),
+            ['page_impressions']
+        )
@@ -0,0 +1,227 @@
+"""Tests for the 'facebook_insights.pipeline' module."""
+import json
+import threading
+
+from django.contrib.contenttypes.models import ContentType
+from django.test import TestCase
+
+from facebook_insights import metrics as metrics_module
+from facebook_insights import models as models_module
+from facebook_insights.metrics import Metric
+from facebook_insights.models import SyncBatch, SyncRun
+from facebook_insights.pipeline import FetchPipeline
+from facebook_insights.tokens import ModelTokenProvider
+from tests.models import Page, PageInsights, PostInsights
+
+try:  # Python 3.3+
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+def fake_fetch_metrics_bulk(graph_ids, metrics, periods=None):
+    return dict(
+        (graph_id, {'post_impressions': Metric(
+            'post_impressions',
+            {'lifetime': [{'value': int(graph_id.split('_')[1])}]},
+        )})
+        for graph_id in graph_ids
+    )
+
+
+class TestFetchPipeline(TestCase):
+    """Tests for the 'FetchPipeline' class."""
+
+    def setUp(self):
+        for i in range(7):
+            PostInsights.objects.create(graph_id='1_{}'.format(i))
+        patcher = mock.patch.object(models_module, 'fetch_metrics_bulk',
+                                    side_effect=fake_fetch_metrics_bulk)
+        self.fetch_metrics_bulk = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_all_objects_are_fetched_and_saved(self):
+        pipeline = FetchPipeline(
+            PostInsights.objects.all(),
+            metrics=['post_impressions'],
+            chunk_size=3,
+            fetch_workers=2,
+        )
+        self.assertEqual(pipeline.run(), {'chunks': 3, 'objects': 7})
+        for post_insights in PostInsights.objects.all():
+            self.assertEqual(post_insights.impressions,
+                             int(post_insights.graph_id.split('_')[1]))
+        chunk_sizes = sorted(len(call[0][0]) for call
+                             in self.fetch_metrics_bulk.call_args_list)
+        self.assertEqual(chunk_sizes, [1, 3, 3])
+
+    def test_pending_chunks_are_bounded(self):
+        pipeline = FetchPipeline(PostInsights.objects.all(), chunk_size=1,
+                                 max_pending_chunks=2)
+        lock = threading.Lock()
+        state = {'read': 0, 'max_pending': 0}
+        iter_chunks = pipeline.iter_chunks
+
+        def counting_iter_chunks():
+            for chunk in iter_chunks():
+                with lock:
+                    state['read'] += 1
+                    state['max_pending'] = max(state['max_pending'],
+                                               state['read'])
+                yield chunk
+
+        def write(chunk):
+            with lock:
+                state['read'] -= 1
+
+        pipeline.iter_chunks = counting_iter_chunks
+        pipeline.write = write
+        self.assertEqual(pipeline.run(), {'chunks': 7, 'objects': 7})
+        self.assertLessEqual(state['max_pending'], 2)
+
+    def test_fetch_errors_are_raised(self):
+        self.fetch_metrics_bulk.side_effect = ValueError('boom')
+        pipeline = FetchPipeline(PostInsights.objects.all(), chunk_size=2)
+        with self.assertRaises(ValueError):
+            pipeline.run()
+
+    def test_workers_use_page_tokens_of_the_calling_thread(self):
+        # The page is created inside the test's transaction, so workers
+        # querying the database on their own wouldn't see it.
+        Page.objects.create(graph_id='1', access_token='page')
+        body = json.dumps({'data': [{
+            'name': 'post_impressions',
+            'period': 'lifetime',
+            'values': [{'value': 1}],
+        }]})
+
+        def put_object(batch, **kwargs):
+            return [{'code': 200, 'body': body}] * len(json.loads(batch))
+
+        graph_api = mock.Mock()
+        graph_api.put_object.side_effect = put_object
+        self.fetch_metrics_bulk.side_effect = (
+            metrics_module.fetch_metrics_bulk
+        )
+        token_provider = ModelTokenProvider('tests.Page', tokens=['pool'])
+        with mock.patch.object(metrics_module, 'token_provider',
+                               token_provider), \
+                mock.patch.object(metrics_module, 'get_graph_api',
+                                  return_value=graph_api) as get_graph_api:
+            pipeline = FetchPipeline(
+                PostInsights.objects.all(),
+                metrics=['post_impressions'],
+                chunk_size=3,
+                fetch_workers=2,
+            )
+            self.assertEqual(pipeline.run(), {'chunks': 3, 'objects': 7})
+        self.assertEqual(
+            set(call[0][0] for call in get_graph_api.call_args_list),
+            set(['page'])
+        )
+        self.assertEqual(
+            PostInsights.objects.filter(impressions=1).count(), 7
+        )
+
+
+class TestSyncRuns(TestCase):
+    """Tests for tracking and resuming runs of 'FetchPipeline'."""
+
+    def setUp(self):
+        self.post_insights = [
+            PostInsights.objects.create(graph_id='1_{}'.format(i))
+            for i in range(7)
+        ]
+        patcher = mock.patch.object(models_module, 'fetch_metrics_bulk',
+                                    side_effect=fake_fetch_metrics_bulk)
+        self.fetch_metrics_bulk = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_fetched_graph_ids(self):
+        return [graph_id for call in self.fetch_metrics_bulk.call_args_list
+                for graph_id in call[0][0]]
+
+    def make_pipeline(self, **kwargs):
+        kwargs.setdefault('chunk_size', 2)
+        return FetchPipeline(PostInsights.objects.all(),
+                             metrics=['post_impressions'], **kwargs)
+
+    def test_run_is_tracked(self):
+        pipeline = self.make_pipeline()
+        pipeline.run()
+        sync_run = SyncRun.objects.get()
+        self.assertEqual(sync_run, pipeline.sync_run)
+        self.assertEqual(sync_run.status, SyncRun.COMPLETED)
+        self.assertEqual(sync_run.objects_done, 7)
+        self.assertEqual(sync_run.cursor, str(self.post_insights[-1].pk))
+        self.assertIsNotNone(sync_run.finished_at)
+        self.assertEqual(
+            list(sync_run.batches.order_by('number').values_list(
+                'number', 'size')),
+            [(0, 2), (1, 2), (2, 2), (3, 1)]
+        )
+
+    def test_interrupted_run_is_resumed(self):
+        def failing_fetch_metrics_bulk(graph_ids, metrics, periods=None):
+            if '1_4' in graph_ids:
+                raise ValueError('boom')
+            return fake_fetch_metrics_bulk(graph_ids, metrics, periods)
+
+        self.fetch_metrics_bulk.side_effect = failing_fetch_metrics_bulk
+        pipeline = self.make_pipeline(checkpoint_interval=1)
+        with self.assertRaises(ValueError):
+            pipeline.run()
+        sync_run = SyncRun.objects.get()
+        self.assertEqual(sync_run.status, SyncRun.FAILED)
+        self.assertEqual(sync_run.objects_done, 4)
+        self.assertEqual(sync_run.cursor, str(self.post_insights[3].pk))
+
+        self.fetch_metrics_bulk.reset_mock()
+        self.fetch_metrics_bulk.side_effect = fake_fetch_metrics_bulk
+        pipeline = self.make_pipeline(resume=sync_run.pk)
+        self.assertEqual(pipeline.run(), {'chunks': 2, 'objects': 3})
+        self.assertEqual(self.get_fetched_graph_ids(), ['1_4', '1_5', '1_6'])
+        sync_run.refresh_from_db()
+        self.assertEqual(sync_run.status, SyncRun.COMPLETED)
+        self.assertEqual(sync_run.objects_done, 7)
+        self.assertEqual(
+            sorted(sync_run.batches.values_list('number', flat=True)),
+            [0, 1, 2, 3]
+        )
+
+    def test_chunks_saved_out_of_order_are_skipped(self):
+        sync_run = SyncRun.objects.create(
+            content_type=ContentType.objects.get_for_model(PostInsights),
+            cursor=str(self.post_insights[1].pk),
+        )
+        SyncBatch.objects.create(
+            run=sync_run,
+            number=2,
+            first_pk=str(self.post_insights[4].pk),
+            last_pk=str(self.post_insights[5].pk),
+            size=2,
+        )
+        pipeline = self.make_pipeline(resume=sync_run.pk)
+        pipeline.run()
+        self.assertEqual(self.get_fetched_graph_ids(), ['1_2', '1_3', '1_6'])
+        self.assertEqual(
+            sorted(sync_run.batches.values_list('number', flat=True)),
+            [2, 3, 4]
+        )
+
+    def test_progress_is_saved_in_batches(self):
+        pipeline = self.make_pipeline(chunk_size=1, checkpoint_interval=3)
+        with mock.patch.object(pipeline, 'checkpoint',
+                               wraps=pipeline.checkpoint) as checkpoint:
+            pipeline.run()
+        batch_counts = [len(call[0][0]) for call in checkpoint.call_args_list]
+        self.assertEqual(batch_counts, [3, 3, 1])
+        self.assertEqual(SyncBatch.objects.count(), 7)
+
+    def test_run_of_another_model_cant_be_resumed(self):
+        sync_run = SyncRun.objects.create(
+            content_type=ContentType.objects.get_for_model(PageInsights),
+        )
+        pipeline = self.make_pipeline(resume=sync_run.pk)
+        with self.assertRaises(ValueError):
+            pipeline.run()
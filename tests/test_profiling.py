@@ -0,0 +1,90 @@
+"""Tests for the 'facebook_insights.profiling' module."""
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase, override_settings
+
+from facebook_insights import models as models_module
+from facebook_insights import profiling
+from facebook_insights.pipeline import FetchPipeline
+from facebook_insights.profiling import phase, profile
+from tests.models import PostInsights
+from tests.test_pipeline import fake_fetch_metrics_bulk
+
+try:  # Python 3.3+
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class TestProfiling(TestCase):
+    """Tests for profiles and phase timers."""
+
+    def setUp(self):
+        for i in range(3):
+            PostInsights.objects.create(graph_id='1_{}'.format(i))
+        patcher = mock.patch.object(models_module, 'fetch_metrics_bulk',
+                                    side_effect=fake_fetch_metrics_bulk)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def run_pipeline(self):
+        FetchPipeline(PostInsights.objects.all(), metrics=['post_impressions'],
+                      chunk_size=2).run()
+
+    def test_phases_are_timed_and_reports_are_written(self):
+        with profile('test', self.directory) as prof:
+            self.run_pipeline()
+        # The last query finds no more objects
+        self.assertEqual(prof.timers['load'][0], 3)
+        self.assertEqual(prof.timers['map'][0], 2)
+        self.assertEqual(prof.timers['save'][0], 2)
+        self.assertEqual(sorted(os.path.splitext(path)[1]
+                                for path in prof.paths),
+                         ['.prof', '.txt'])
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         sorted(os.path.basename(path) for path in prof.paths))
+        report = prof.get_report()
+        self.assertIn('save', report)
+        self.assertIn('cumulative', report)
+        if profiling._tracemalloc is not None:
+            self.assertIn('Memory allocated', report)
+
+    def test_unsampled_block_is_not_profiled(self):
+        with profile('test', self.directory, sample_rate=0) as prof:
+            with phase('load'):
+                pass
+        self.assertIsNone(prof)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_nested_profiles_are_merged(self):
+        with profile('outer', cprofile=False) as outer:
+            with profile('inner') as inner:
+                with phase('parse'):
+                    pass
+        self.assertIs(inner, outer)
+        self.assertEqual(outer.timers['parse'][0], 1)
+
+    def test_runs_are_profiled_if_enabled(self):
+        self.run_pipeline()
+        self.assertEqual(os.listdir(self.directory), [])
+        options = {'directory': self.directory, 'tracemalloc': False}
+        with override_settings(FACEBOOK_INSIGHTS_PROFILING=options):
+            self.run_pipeline()
+        self.assertEqual(
+            sorted(os.path.splitext(name)[1]
+                   for name in os.listdir(self.directory)),
+            ['.prof', '.txt']
+        )
+
+    def test_fetch_due_is_profiled_if_enabled(self):
+        PostInsights.objects.all().schedule()
+        options = {'directory': self.directory, 'cprofile': False,
+                   'tracemalloc': False}
+        with override_settings(FACEBOOK_INSIGHTS_PROFILING=options):
+            PostInsights.objects.fetch_due()
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.assertTrue(os.listdir(self.directory)[0].startswith('fetch_due'))
@@ -0,0 +1,138 @@
+"""Tests for the 'facebook_insights.routers' module."""
+from django.db import connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from facebook_insights import models as models_module
+from facebook_insights.models import FetchSchedule, SyncRun
+from facebook_insights.pipeline import FetchPipeline
+from facebook_insights.routers import InsightsRouter
+from tests.models import Post, PostInsights, PostInsightsWithoutGraphID
+from tests.test_pipeline import fake_fetch_metrics_bulk
+
+try:  # Python 3.3+
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+@override_settings(FACEBOOK_INSIGHTS_READ_DATABASE='replica',
+                   FACEBOOK_INSIGHTS_WRITE_DATABASE='analytics')
+class TestInsightsRouter(TestCase):
+    """Tests for the 'InsightsRouter' class."""
+
+    def setUp(self):
+        self.router = InsightsRouter()
+
+    def test_insights_models_are_routed(self):
+        for model in [PostInsights, PostInsightsWithoutGraphID, FetchSchedule,
+                      SyncRun]:
+            self.assertEqual(self.router.db_for_read(model), 'replica')
+            self.assertEqual(self.router.db_for_write(model), 'analytics')
+
+    @override_settings(FACEBOOK_INSIGHTS_READ_DATABASE=None)
+    def test_reads_default_to_write_database(self):
+        self.assertEqual(self.router.db_for_read(PostInsights), 'analytics')
+
+    def test_other_models_are_not_routed(self):
+        self.assertIsNone(self.router.db_for_read(Post))
+        self.assertIsNone(self.router.db_for_write(Post))
+
+    def test_migrations_go_to_write_database(self):
+        self.assertTrue(self.router.allow_migrate('analytics',
+                                                  'facebook_insights'))
+        self.assertFalse(self.router.allow_migrate('replica',
+                                                   'facebook_insights'))
+        self.assertFalse(self.router.allow_migrate('default', 'tests',
+                                                   'postinsights'))
+        self.assertIsNone(self.router.allow_migrate('default', 'tests',
+                                                    'post'))
+
+    def test_relations_between_databases_are_allowed(self):
+        post = Post(graph_id='1_1')
+        post._state.db = 'replica'
+        post_insights = PostInsightsWithoutGraphID(post=post)
+        post_insights._state.db = 'analytics'
+        self.assertTrue(self.router.allow_relation(post_insights, post))
+        post._state.db = 'other'
+        self.assertIsNone(self.router.allow_relation(post_insights, post))
+
+
+@override_settings(
+    DATABASE_ROUTERS=['facebook_insights.routers.InsightsRouter'],
+    FACEBOOK_INSIGHTS_READ_DATABASE='replica',
+)
+class TestRouting(TransactionTestCase):
+    """Tests for routing queries of a fetch."""
+    # The replica mirrors the default database, so it only sees committed
+    # data.
+    multi_db = True
+
+    def setUp(self):
+        for i in range(3):
+            PostInsights.objects.using('default').create(
+                graph_id='1_{}'.format(i),
+            )
+        patcher = mock.patch.object(models_module, 'fetch_metrics_bulk',
+                                    side_effect=fake_fetch_metrics_bulk)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_objects_are_read_from_replica_and_saved_to_primary(self):
+        pipeline = FetchPipeline(PostInsights.objects.all(),
+                                 metrics=['post_impressions'])
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            pipeline.run()
+        replica_sql = [query['sql'] for query in replica.captured_queries]
+        primary_sql = [query['sql'] for query in primary.captured_queries]
+        self.assertTrue(any('tests_postinsights' in sql
+                            for sql in replica_sql))
+        self.assertTrue(all(sql.startswith('SELECT') for sql in replica_sql))
+        self.assertFalse(any(sql.startswith('SELECT') and
+                             'tests_postinsights' in sql
+                             for sql in primary_sql))
+        self.assertTrue(any(sql.startswith('UPDATE') and
+                            'tests_postinsights' in sql
+                            for sql in primary_sql))
+
+    def test_due_objects_are_read_from_replica(self):
+        PostInsights.objects.all().schedule()
+        with CaptureQueriesContext(connections['replica']) as replica:
+            fetched = PostInsights.objects.fetch_due()
+        self.assertEqual(len(fetched), 3)
+        self.assertTrue(any('facebook_insights_fetchschedule' in query['sql']
+                            for query in replica.captured_queries))
+        self.assertEqual(FetchSchedule.objects.using('default').filter(
+            last_fetched_at__isnull=False).count(), 3)
+
+
+@override_settings(
+    DATABASE_ROUTERS=['facebook_insights.routers.InsightsRouter'],
+    FACEBOOK_INSIGHTS_WRITE_DATABASE='analytics',
+)
+class TestRoutingWithoutReplica(TestCase):
+    """Tests for routing queries to a write database other than 'default',
+    when no read database is set.
+    """
+    multi_db = True
+
+    def setUp(self):
+        for i in range(3):
+            PostInsights.objects.create(graph_id='1_{}'.format(i))
+        patcher = mock.patch.object(models_module, 'fetch_metrics_bulk',
+                                    side_effect=fake_fetch_metrics_bulk)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_objects_are_read_from_write_database(self):
+        self.assertEqual(
+            PostInsights.objects.using('analytics').count(), 3
+        )
+        PostInsights.objects.all().schedule()
+        self.assertEqual(FetchSchedule.objects.using('analytics').count(), 3)
+        fetched = PostInsights.objects.fetch_due()
+        self.assertEqual(len(fetched), 3)
+        self.assertEqual(FetchSchedule.objects.using('analytics').filter(
+            last_fetched_at__isnull=False).count(), 3)
+        self.assertFalse(PostInsights.objects.using('default').exists())
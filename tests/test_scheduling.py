@@ -0,0 +1,130 @@
+"""Tests for the 'facebook_insights.scheduling' module and the scheduling
+methods of Insights querysets.
+"""
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils import timezone
+
+from facebook_insights import models as models_module
+from facebook_insights.metrics import Metric
+from facebook_insights.models import FetchSchedule
+from facebook_insights.scheduling import get_activity, get_fetch_interval
+from tests.models import PostInsights
+
+try:  # Python 3.3+
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class TestFetchInterval(TestCase):
+    """Tests for get_fetch_interval() and get_activity()."""
+
+    def test_interval_grows_with_age(self):
+        self.assertEqual(get_fetch_interval(timedelta(hours=5)),
+                         timedelta(hours=1))
+        self.assertEqual(get_fetch_interval(timedelta(days=3)),
+                         timedelta(hours=6))
+        self.assertEqual(get_fetch_interval(timedelta(days=10)),
+                         timedelta(days=1))
+        self.assertEqual(get_fetch_interval(timedelta(days=100)),
+                         timedelta(days=7))
+
+    def test_interval_depends_on_activity(self):
+        age = timedelta(days=10)
+        self.assertEqual(get_fetch_interval(age, activity=0.5),
+                         timedelta(hours=12))
+        self.assertEqual(get_fetch_interval(age, activity=0.01),
+                         timedelta(days=1))
+        self.assertEqual(get_fetch_interval(age, activity=0),
+                         timedelta(days=2))
+
+    def test_custom_intervals(self):
+        intervals = [(timedelta(days=1), timedelta(minutes=5)),
+                     (None, timedelta(hours=1))]
+        self.assertEqual(get_fetch_interval(timedelta(0), None, intervals),
+                         timedelta(minutes=5))
+        self.assertEqual(get_fetch_interval(timedelta(days=2), None,
+                                            intervals),
+                         timedelta(hours=1))
+
+    def test_get_activity(self):
+        self.assertIsNone(get_activity(None, {'impressions': 10}))
+        self.assertEqual(
+            get_activity({'impressions': 10}, {'impressions': 10}),
+            0
+        )
+        self.assertEqual(
+            get_activity({'impressions': 10, 'stories': None},
+                         {'impressions': 15, 'stories': None}),
+            0.5
+        )
+        # JSON-serialized values are taken into account as well
+        self.assertEqual(
+            get_activity({'stories_by_action_type': '{"like": 8, "share": 2}'},
+                         {'stories_by_action_type': '{"like": 9, "share": 3}'}),
+            0.2
+        )
+
+
+class TestFetchDue(TestCase):
+    """Tests for the scheduling methods of InsightsQuerySet."""
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.first = PostInsights.objects.create(graph_id='1_1')
+        self.second = PostInsights.objects.create(graph_id='1_2')
+
+    def fetch_due(self, impressions, now):
+        def fetch_metrics_bulk(graph_ids, metrics, periods=None):
+            return dict(
+                (graph_id, {'post_impressions': Metric(
+                    'post_impressions',
+                    {'lifetime': [{'value': impressions}]},
+                )})
+                for graph_id in graph_ids
+            )
+        with mock.patch.object(models_module, 'fetch_metrics_bulk',
+                               side_effect=fetch_metrics_bulk):
+            return PostInsights.objects.fetch_due(now=now)
+
+    def test_unscheduled_objects_are_not_due(self):
+        self.assertFalse(PostInsights.objects.due(now=self.now).exists())
+
+    def test_scheduled_objects_are_due_immediately(self):
+        PostInsights.objects.filter(pk=self.first.pk).schedule(now=self.now)
+        self.assertEqual(list(PostInsights.objects.due(now=self.now)),
+                         [self.first])
+        # Registering twice doesn't create duplicates
+        PostInsights.objects.all().schedule(now=self.now)
+        self.assertEqual(FetchSchedule.objects.count(), 2)
+
+    def test_fetch_due_saves_and_reschedules_objects(self):
+        now = self.now
+        PostInsights.objects.all().schedule(now=now)
+        fetched = self.fetch_due(impressions=100, now=now)
+        self.assertEqual(len(fetched), 2)
+        self.assertEqual(
+            PostInsights.objects.get(pk=self.first.pk).impressions,
+            100
+        )
+        self.assertFalse(PostInsights.objects.due(now=now).exists())
+        schedule = FetchSchedule.objects.get(object_id=str(self.first.pk))
+        # The objects are new, so they're fetched again in an hour
+        self.assertEqual(schedule.next_fetch_at, now + timedelta(hours=1))
+        # Objects that didn't change are fetched twice as rarely
+        now += timedelta(hours=1)
+        self.fetch_due(impressions=100, now=now)
+        schedule = FetchSchedule.objects.get(object_id=str(self.first.pk))
+        self.assertEqual(schedule.next_fetch_at, now + timedelta(hours=2))
+        # Active objects are fetched twice as often
+        now += timedelta(hours=2)
+        self.fetch_due(impressions=200, now=now)
+        schedule = FetchSchedule.objects.get(object_id=str(self.first.pk))
+        self.assertEqual(schedule.next_fetch_at, now + timedelta(minutes=30))
+
+    def test_fetch_due_respects_limit(self):
+        PostInsights.objects.all().schedule(now=self.now)
+        self.assertEqual(PostInsights.objects.due(now=self.now,
+                                                  limit=1).count(), 1)
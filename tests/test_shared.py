@@ -0,0 +1,98 @@
+"""Tests for the 'facebook_insights.shared' module."""
+import json
+
+from django.test import TestCase
+
+from facebook_insights import shared as shared_module
+from facebook_insights.metrics import Metric
+from facebook_insights.shared import SharedFetch
+from tests.models import PageDailyInsights, PageInsights
+
+try:  # Python 3.3+
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+def fake_fetch_metrics_by_id(metrics_by_id, periods=None):
+    fetched_metrics = {}
+    for graph_id, metrics in metrics_by_id:
+        fetched_metrics[graph_id] = dict(
+            (metric, Metric(metric, {
+                'day': [{'value': 1}],
+                'week': [{'value': 7}],
+            }))
+            for metric in metrics
+        )
+    return fetched_metrics
+
+
+class TestSharedFetch(TestCase):
+    """Tests for the 'SharedFetch' class."""
+
+    def setUp(self):
+        for graph_id in ['1', '2']:
+            PageInsights.objects.create(graph_id=graph_id)
+        for graph_id in ['2', '3']:
+            PageDailyInsights.objects.create(graph_id=graph_id)
+        patcher = mock.patch.object(shared_module, 'fetch_metrics_by_id',
+                                    side_effect=fake_fetch_metrics_by_id)
+        self.fetch_metrics_by_id = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_shared_fetch(self):
+        shared_fetch = SharedFetch()
+        shared_fetch.register(PageInsights.objects.all(),
+                              metrics=['page_impressions',
+                                       'page_engaged_users'])
+        shared_fetch.register(PageDailyInsights.objects.all())
+        return shared_fetch
+
+    def test_metrics_are_fetched_once_per_object(self):
+        self.make_shared_fetch().fetch()
+        self.assertEqual(self.fetch_metrics_by_id.call_count, 1)
+        metrics_by_id, periods = self.fetch_metrics_by_id.call_args[0]
+        self.assertEqual(
+            sorted((graph_id, sorted(metrics))
+                   for graph_id, metrics in metrics_by_id),
+            [
+                ('1', ['page_engaged_users', 'page_impressions']),
+                ('2', ['page_engaged_users', 'page_fans',
+                       'page_impressions']),
+                ('3', ['page_fans', 'page_impressions']),
+            ]
+        )
+        # Only PageDailyInsights restricts periods of 'page_impressions'
+        self.assertEqual(periods, {})
+
+    def test_metrics_are_fanned_out_to_all_models(self):
+        shared_fetch = self.make_shared_fetch()
+        page_insights, page_daily_insights = shared_fetch.fetch()
+        shared_fetch.save()
+        for instance in PageInsights.objects.all():
+            self.assertEqual(json.loads(instance.impressions),
+                             {'day': 1, 'week': 7})
+            self.assertEqual(json.loads(instance.engaged_users),
+                             {'day': 1, 'week': 7})
+        for instance in PageDailyInsights.objects.all():
+            # Only the period listed in PERIODS is stored
+            self.assertEqual(instance.impressions, 1)
+            self.assertEqual(json.loads(instance.fans),
+                             {'day': 1, 'week': 7})
+        self.assertEqual([len(page_insights), len(page_daily_insights)],
+                         [2, 2])
+
+    def test_agreed_periods_are_requested(self):
+        shared_fetch = SharedFetch()
+        shared_fetch.register(PageDailyInsights.objects.all())
+        shared_fetch.register(PageDailyInsights.objects.filter(graph_id='2'),
+                              metrics=['page_impressions'])
+        self.assertEqual(shared_fetch.get_periods(),
+                         {'page_impressions': 'day'})
+
+    def test_nothing_is_fetched_for_empty_querysets(self):
+        shared_fetch = SharedFetch()
+        shared_fetch.register(PageInsights.objects.none())
+        self.assertEqual(shared_fetch.fetch(), [[]])
+        shared_fetch.save()
+        self.assertFalse(self.fetch_metrics_by_id.called)
@@ -0,0 +1,137 @@
+"""Tests for the 'facebook_insights.tokens' module."""
+import json
+
+from django.test import TestCase
+from facebook import GraphAPIError
+
+from facebook_insights import metrics as metrics_module
+from facebook_insights.exceptions import NoAccessToken
+from facebook_insights.tokens import (ModelTokenProvider,
+                                      SettingsTokenProvider, get_page_id)
+from tests.models import Page
+
+try:  # Python 3.3+
+    from unittest import mock
+except ImportError:
+    import mock
+
+TEST_PAGE_ID = '327730534261730'
+TEST_POST_ID = '327730534261730_327732570928193'
+THROTTLED = {'code': 4, 'message': 'Application request limit reached'}
+EXPIRED = {'code': 190, 'message': 'Error validating access token'}
+
+
+class TestSettingsTokenProvider(TestCase):
+    """Tests for the 'SettingsTokenProvider' class."""
+
+    def test_tokens_are_provided_in_turn(self):
+        provider = SettingsTokenProvider(['a', 'b', 'c'])
+        tokens = [provider.get_token(TEST_PAGE_ID) for _ in range(4)]
+        self.assertEqual(tokens, ['a', 'b', 'c', 'a'])
+
+    def test_throttled_token_is_put_aside(self):
+        provider = SettingsTokenProvider(['a', 'b'], cooldown=60)
+        self.assertTrue(provider.report_error('a', THROTTLED))
+        tokens = [provider.get_token(TEST_PAGE_ID) for _ in range(3)]
+        self.assertEqual(tokens, ['b', 'b', 'b'])
+        with mock.patch('time.time', return_value=2 ** 40):
+            self.assertEqual(
+                set(provider.get_token(TEST_PAGE_ID) for _ in range(2)),
+                set(['a', 'b'])
+            )
+
+    def test_expired_token_is_removed(self):
+        provider = SettingsTokenProvider(['a', 'b'])
+        self.assertTrue(provider.report_error('a', EXPIRED))
+        self.assertEqual(provider.tokens, ['b'])
+        self.assertTrue(provider.report_error('b', EXPIRED))
+        with self.assertRaises(NoAccessToken):
+            provider.get_token(TEST_PAGE_ID)
+
+    def test_other_errors_are_ignored(self):
+        provider = SettingsTokenProvider(['a'])
+        self.assertFalse(provider.report_error('a', {'code': 100}))
+        self.assertEqual(provider.get_token(TEST_PAGE_ID), 'a')
+
+
+class TestModelTokenProvider(TestCase):
+    """Tests for the 'ModelTokenProvider' class."""
+
+    def setUp(self):
+        Page.objects.create(graph_id=TEST_PAGE_ID, access_token='page')
+        Page.objects.create(graph_id='42', access_token='')
+        self.provider = ModelTokenProvider('tests.Page', tokens=['pool'])
+
+    def test_get_page_id(self):
+        self.assertEqual(get_page_id(TEST_PAGE_ID), TEST_PAGE_ID)
+        self.assertEqual(get_page_id(TEST_POST_ID), TEST_PAGE_ID)
+
+    def test_page_tokens_are_looked_up_by_page_id(self):
+        with self.assertNumQueries(1):
+            tokens = self.provider.get_tokens(
+                [TEST_PAGE_ID, TEST_POST_ID, '42', '43_44']
+            )
+        self.assertEqual(tokens, {
+            TEST_PAGE_ID: 'page',
+            TEST_POST_ID: 'page',
+            '42': 'pool',
+            '43_44': 'pool',
+        })
+
+    def test_expired_page_token_is_replaced_with_pool_token(self):
+        provider = self.provider
+        self.assertTrue(provider.report_error('page', EXPIRED))
+        self.assertEqual(provider.get_token(TEST_POST_ID), 'pool')
+
+    def test_prefetched_tokens_are_provided_without_queries(self):
+        provider = self.provider
+        with self.assertNumQueries(1):
+            prefetched = provider.prefetch([TEST_POST_ID, '42'])
+        with self.assertNumQueries(0), prefetched:
+            tokens = provider.get_tokens([TEST_POST_ID, '42'])
+        self.assertEqual(tokens, {TEST_POST_ID: 'page', '42': 'pool'})
+
+
+class TestTokenRouting(TestCase):
+    """Tests for routing of batch requests to tokens."""
+
+    def setUp(self):
+        patcher = mock.patch.object(
+            metrics_module,
+            'token_provider',
+            SettingsTokenProvider(['a', 'b']),
+        )
+        self.provider = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_requests_carry_their_tokens(self):
+        response = {'code': 200, 'body': json.dumps({'data': []})}
+        graph_api = mock.Mock()
+        graph_api.put_object.return_value = [response] * 2
+        with mock.patch.object(metrics_module, 'get_graph_api',
+                               return_value=graph_api) as get_graph_api:
+            metrics_module._request_batch([('1', 'page_impressions'),
+                                           ('2', 'page_impressions')])
+        batch = json.loads(graph_api.put_object.call_args[1]['batch'])
+        batch_token = get_graph_api.call_args[0][0]
+        other_token = ({'a', 'b'} - {batch_token}).pop()
+        self.assertNotIn('access_token', batch[0]['relative_url'])
+        self.assertTrue(
+            batch[1]['relative_url'].endswith('access_token=' + other_token)
+        )
+
+    def test_batch_is_retried_with_another_token(self):
+        response = {'code': 200, 'body': json.dumps({'data': []})}
+        graph_api = mock.Mock()
+        graph_api.put_object.side_effect = [
+            GraphAPIError({'error': THROTTLED}),
+            [response],
+        ]
+        with mock.patch.object(metrics_module, 'get_graph_api',
+                               return_value=graph_api) as get_graph_api:
+            batch_response = metrics_module._request_batch(
+                [(TEST_PAGE_ID, 'page_impressions')]
+            )
+        self.assertEqual(batch_response, [response])
+        tokens = [call[0][0] for call in get_graph_api.call_args_list]
+        self.assertEqual(tokens, ['a', 'b'])